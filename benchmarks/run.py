@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+run.py
+
+Reproducible benchmarks of the ingest -> embed -> cluster pipeline on
+synthetic data (see synthetic.py), so performance can be compared across
+commits without a firehose connection, an embedding server or a GPU:
+
+  decode        firehose frames and posts decoded per second, inline and
+                through FirehosePipeline with a pool of decode workers
+  flush         latency of writing one segment (plus its rollup update) and
+                of compacting a day
+  embed_client  EmbeddingClient throughput against a local mock endpoint
+  kmeans        seconds per Lloyd iteration for a grid of N, k and dim
+  frame         time per window of cluster_video.py: warm-started KMeans,
+                cluster matching, statistics, projection and rendering
+
+Every run writes one JSON file with the results and the commit, library
+versions and device it was measured on:
+    python run.py --output results/$(git rev-parse --short HEAD).json
+    python run.py --quick --only decode kmeans
+
+Command-line arguments:
+  --only    (benchmarks to run, default all)
+  --quick   (smaller inputs, for a smoke test)
+  --output  (JSON file to write, default benchmark_<timestamp>.json)
+  --seed    (seed of the synthetic data)
+"""
+
+import argparse as ap
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pyarrow as pa
+import torch
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(bench_dir, "..", "scripts"))
+sys.path.append(os.path.join(bench_dir, "..", "notebooks"))
+
+from synthetic import MockEmbeddingServer, firehose_messages, random_embeddings, random_texts
+
+# Same columns as firehose_scraper.POST_SCHEMA; importing the scraper would
+# create its data directories
+POST_SCHEMA = pa.schema([
+    ("text", pa.string()),
+    ("createdAt", pa.string()),
+    ("uri", pa.string()),
+    ("lang", pa.string()),
+])
+
+FULL = {
+    "decode_frames": 20_000,
+    "decode_workers": [1, 4],
+    "flush_segments": 50,
+    "flush_posts": 1000,
+    "embed_posts": 20_000,
+    "embed_dim": 768,
+    "kmeans_grid": [(20_000, 100, 256), (20_000, 500, 256), (20_000, 500, 1024), (100_000, 500, 1024)],
+    "kmeans_iter": 10,
+    "frame_rows": 20_000,
+    "frame_clusters": 500,
+    "frame_dim": 1024,
+    "frame_windows": 3,
+}
+QUICK = {
+    "decode_frames": 2000,
+    "decode_workers": [2],
+    "flush_segments": 10,
+    "flush_posts": 1000,
+    "embed_posts": 2000,
+    "embed_dim": 256,
+    "kmeans_grid": [(5000, 50, 128), (5000, 200, 256)],
+    "kmeans_iter": 5,
+    "frame_rows": 5000,
+    "frame_clusters": 100,
+    "frame_dim": 256,
+    "frame_windows": 2,
+}
+
+
+def percentiles(seconds: list) -> dict:
+    ms = np.asarray(seconds) * 1000
+    return {
+        "mean_ms": round(float(ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+def bench_decode(config: dict, seed: int) -> dict:
+    from firehose_pipeline import FirehosePipeline, extract_posts
+
+    messages = firehose_messages(config["decode_frames"], seed=seed)
+    results = {"frames": len(messages)}
+
+    start = time.perf_counter()
+    posts = sum(len(extract_posts(message)) for message in messages)
+    elapsed = time.perf_counter() - start
+    results["inline"] = {
+        "frames_per_s": round(len(messages) / elapsed, 1),
+        "posts_per_s": round(posts / elapsed, 1),
+    }
+
+    for num_workers in config["decode_workers"]:
+        decoded = []
+        pipeline = FirehosePipeline(lambda posts, seq: decoded.append(len(posts)), num_workers,
+                                    stats_interval=float("inf"))
+        pipeline.start()
+        start = time.perf_counter()
+        for message in messages:
+            pipeline.on_message(message)
+        pipeline.stop()
+        elapsed = time.perf_counter() - start
+        results[f"pipeline_{num_workers}_workers"] = {
+            "frames_per_s": round(len(decoded) / elapsed, 1),
+            "posts_per_s": round(sum(decoded) / elapsed, 1),
+            "frames_blocked": pipeline.stats.frames_blocked,
+        }
+    return results
+
+
+def bench_flush(config: dict, seed: int) -> dict:
+    from rollups import RollupStore
+    from segment_writer import DaySegmentWriter
+
+    texts = random_texts(config["flush_posts"], seed)
+    day = "2025-01-20"
+    with tempfile.TemporaryDirectory() as data_dir:
+        rollups = RollupStore(data_dir)
+        writer = DaySegmentWriter(data_dir, POST_SCHEMA, on_segment=rollups.add_segment,
+                                  on_finalize=rollups.rebuild_day)
+        seconds = []
+        for segment in range(config["flush_segments"]):
+            posts = [{
+                "text": text,
+                "createdAt": f"{day}T{segment % 24:02d}:{i % 60:02d}:00.000Z",
+                "uri": f"at://did:plc:benchmark/app.bsky.feed.post/{segment}r{i}",
+                "lang": "en",
+            } for i, text in enumerate(texts)]
+            start = time.perf_counter()
+            writer.write_segment(day, posts, {"seq": segment})
+            seconds.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        rows = writer.finalize_day(day)
+        finalize_seconds = time.perf_counter() - start
+
+    return {
+        "posts_per_segment": config["flush_posts"],
+        "segment": percentiles(seconds),
+        "finalize_rows": rows,
+        "finalize_s": round(finalize_seconds, 3),
+    }
+
+
+def bench_embed_client(config: dict, seed: int) -> dict:
+    from embed_client import EmbeddingClient
+
+    texts = random_texts(config["embed_posts"], seed)
+    results = {"posts": len(texts), "dim": config["embed_dim"]}
+    with MockEmbeddingServer(dim=config["embed_dim"]) as server:
+        for concurrency in (1, 8, 32):
+            client = EmbeddingClient(server.url, concurrency=concurrency, report_interval=float("inf"))
+            received = []
+            report = client.embed(range(len(texts)), texts, lambda indices, embeddings: received.append(len(indices)))
+            assert sum(received) == len(texts)
+            results[f"concurrency_{concurrency}"] = {
+                key: report[key] for key in ("requests", "elapsed_s", "posts_per_s", "tokens_per_s")
+            }
+    return results
+
+
+def bench_kmeans(config: dict, seed: int, device: torch.device) -> dict:
+    from accelerate import KMeansEngine
+
+    results = []
+    for n, k, dim in config["kmeans_grid"]:
+        X = torch.from_numpy(random_embeddings(n, dim, n_centers=k, seed=seed)).to(device)
+        # tol=0 so the configurations run (nearly always) the same number of iterations
+        engine = KMeansEngine(k, max_iter=config["kmeans_iter"], tol=0, seed=seed)
+        engine.fit(X)
+        # The first iteration includes allocator and kernel warm-up
+        seconds = engine.iteration_seconds[1:] or engine.iteration_seconds
+        results.append({"n": n, "k": k, "dim": dim, "iterations": engine.n_iter,
+                        "s_per_iter": round(float(np.mean(seconds)), 4)})
+    return results
+
+
+def bench_frame(config: dict, seed: int, device: torch.device) -> dict:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from sklearn.decomposition import IncrementalPCA
+
+    from cluster_stats import cluster_window, rank_clusters
+
+    n, k, dim = config["frame_rows"], config["frame_clusters"], config["frame_dim"]
+    stages = {name: [] for name in ("kmeans", "match", "statistics", "projection", "render")}
+    previous_means = None
+    pca = IncrementalPCA(n_components=2)
+
+    def timed(name, fn):
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        stages[name].append(time.perf_counter() - start)
+        return result
+
+    with tempfile.TemporaryDirectory() as frame_dir:
+        for window in range(config["frame_windows"]):
+            X = torch.from_numpy(random_embeddings(n, dim, n_centers=k, seed=seed + window)).to(device)
+
+            # The same step as cluster_video.cluster_windows
+            labels, means, stats, _ = cluster_window(X, k, previous_means, max_iter=20, warm_start_iter=20,
+                                                     seed=seed, timed=timed)
+            previous_means = means
+            best_clusters = rank_clusters(stats, 0)
+
+            def project():
+                pca.partial_fit(means.cpu().numpy())
+                components = torch.from_numpy(pca.components_.T.astype(np.float32)).to(device)
+                offset = torch.from_numpy(pca.mean_.astype(np.float32)).to(device)
+                return ((X - offset) @ components).cpu().numpy(), pca.transform(means.cpu().numpy())
+            points, centroids = timed("projection", project)
+            labels = labels.cpu().numpy()
+
+            def render():
+                cmap = plt.get_cmap("jet")
+                fig = plt.figure()
+                for i, cluster in enumerate(best_clusters):
+                    color = cmap(i / len(best_clusters))
+                    plt.scatter(centroids[cluster, 0], centroids[cluster, 1], color=color, marker="x")
+                    cluster_points = points[labels == cluster]
+                    plt.scatter(cluster_points[:, 0], cluster_points[:, 1], color=color, alpha=0.1)
+                fig.savefig(os.path.join(frame_dir, f"frame_{window:03d}.png"))
+                plt.close(fig)
+            timed("render", render)
+
+    results = {"rows": n, "clusters": k, "dim": dim, "windows": config["frame_windows"]}
+    for name, seconds in stages.items():
+        results[f"{name}_s"] = round(float(np.mean(seconds)), 4) if seconds else None
+    # The first window is clustered from scratch, the others are warm-started
+    results["first_window_s"] = round(sum(stage[0] for name, stage in stages.items() if name != "match"), 4)
+    if config["frame_windows"] > 1:
+        results["warm_window_s"] = round(sum(float(np.mean(stage[-(config["frame_windows"] - 1):]))
+                                             for stage in stages.values()), 4)
+    return results
+
+
+def metadata(device: torch.device) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=bench_dir, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=bench_dir,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pyarrow": pa.__version__,
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "device": torch.cuda.get_device_name(device) if device.type == "cuda" else "cpu",
+    }
+
+
+BENCHMARKS = ["decode", "flush", "embed_client", "kmeans", "frame"]
+
+
+def main(args):
+    config = QUICK if args.quick else FULL
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(args.seed)
+
+    results = {"meta": metadata(device), "quick": args.quick, "seed": args.seed}
+    for name in args.only or BENCHMARKS:
+        print(f"Running {name}...")
+        start = time.perf_counter()
+        if name == "decode":
+            results[name] = bench_decode(config, args.seed)
+        elif name == "flush":
+            results[name] = bench_flush(config, args.seed)
+        elif name == "embed_client":
+            results[name] = bench_embed_client(config, args.seed)
+        elif name == "kmeans":
+            results[name] = bench_kmeans(config, args.seed, device)
+        elif name == "frame":
+            results[name] = bench_frame(config, args.seed, device)
+        print(json.dumps(results[name], indent=2))
+        print(f"{name} took {time.perf_counter() - start:.1f}s")
+
+    output = args.output or f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    arg_parser = ap.ArgumentParser(description="Benchmark the pipeline on synthetic data.")
+    arg_parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=None,
+                            help="Benchmarks to run (default: all).")
+    arg_parser.add_argument("--quick", action="store_true",
+                            help="Run on small inputs, e.g. as a smoke test.")
+    arg_parser.add_argument("--output", type=str, default=None,
+                            help="JSON file for the results.")
+    arg_parser.add_argument("--seed", type=int, default=0,
+                            help="Seed of the synthetic data and KMeans.")
+    args = arg_parser.parse_args()
+
+    main(args)
@@ -0,0 +1,180 @@
+"""
+synthetic.py
+
+Deterministic synthetic inputs for the benchmarks in run.py:
+  - firehose commit frames carrying app.bsky.feed.post records, encoded as
+    DAG-CBOR with a CAR of blocks like the relay sends them,
+  - random post texts with realistic lengths and some exact repeats,
+  - random embedding matrices drawn around a number of cluster centers,
+  - a local mock of a text-embeddings-inference endpoint.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import libipld
+import numpy as np
+from atproto_firehose.models import MessageFrame, MessageFrameHeader
+
+WORDS = (
+    "the a to and of in is for on that it with this be are at was have not you from but "
+    "just like so what all about out more one people can if new day time now get today "
+    "think good love know really would will see back make news world vote music art game "
+    "book photo post thread bluesky election trump policy climate science city team win"
+).split()
+
+
+def random_texts(n: int, seed: int = 0, repeat_fraction: float = 0.05) -> list:
+    """
+    Returns `n` post-like texts of 3 to 60 words; about `repeat_fraction` of
+    them repeat an earlier text, like "gm" posts and spam do.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = np.minimum(rng.geometric(1 / 18, size=n) + 2, 60)
+    texts = []
+    for i, length in enumerate(lengths):
+        if texts and rng.random() < repeat_fraction:
+            texts.append(texts[rng.integers(len(texts))])
+        else:
+            texts.append(" ".join(rng.choice(WORDS, size=length)) + f" #{i}")
+    return texts
+
+
+def random_embeddings(n: int, dim: int, n_centers: int = 100, spread: float = 0.3,
+                      seed: int = 0) -> np.ndarray:
+    """
+    Returns an (n, dim) float32 matrix of unit vectors scattered around
+    `n_centers` random directions.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_centers, dim)).astype(np.float32)
+    X = centers[rng.integers(n_centers, size=n)] + spread * rng.standard_normal((n, dim)).astype(np.float32)
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    return X
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _cid(data: bytes) -> bytes:
+    # CIDv1, dag-cbor, sha2-256
+    return bytes([0x01, 0x71, 0x12, 0x20]) + hashlib.sha256(data).digest()
+
+
+def _car(blocks: list, root: bytes) -> bytes:
+    header = libipld.encode_dag_cbor({"version": 1, "roots": [root]})
+    out = _varint(len(header)) + header
+    for cid, data in blocks:
+        out += _varint(len(cid) + len(data)) + cid + data
+    return out
+
+
+def firehose_frame(seq: int, texts: list, repo: str = "did:plc:benchmark", langs=("en",)) -> bytes:
+    """
+    Returns the wire bytes (header + body) of a #commit frame creating one
+    post per text.
+    """
+    now = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+    blocks, ops = [], []
+    for i, text in enumerate(texts):
+        record = libipld.encode_dag_cbor({
+            "$type": "app.bsky.feed.post", "text": text, "langs": list(langs), "createdAt": now,
+        })
+        cid = _cid(record)
+        blocks.append((cid, record))
+        ops.append({"action": "create", "path": f"app.bsky.feed.post/{seq}r{i}", "cid": cid})
+    root = _cid(b"root" + str(seq).encode())
+    body = {
+        "seq": seq, "repo": repo, "rev": "benchmark", "since": None, "commit": root,
+        "blocks": _car(blocks, root), "ops": ops, "time": now,
+        "tooBig": False, "rebase": False, "blobs": [],
+    }
+    return libipld.encode_dag_cbor({"op": 1, "t": "#commit"}) + libipld.encode_dag_cbor(body)
+
+
+def firehose_messages(n_frames: int, posts_per_frame: int = 3, seed: int = 0) -> list:
+    """
+    Returns `n_frames` decoded message frames, as the firehose client hands
+    them to its callback.
+    """
+    texts = random_texts(n_frames * posts_per_frame, seed)
+    messages = []
+    for seq in range(n_frames):
+        frame = firehose_frame(seq + 1, texts[seq * posts_per_frame:(seq + 1) * posts_per_frame])
+        header, body = libipld.decode_dag_cbor_multi(frame)
+        messages.append(MessageFrame(MessageFrameHeader(t=header["t"]), body))
+    return messages
+
+
+class MockEmbeddingServer:
+    """
+    Local TEI-style endpoint answering POST {"inputs": [...]} with one
+    `dim`-dimensional vector per input after `latency` seconds. Use as a
+    context manager; `url` is valid inside the block.
+
+    The first requests are answered with `statuses` (e.g. 429, 503) instead,
+    one each, and requests with more than `max_inputs` texts with a 413.
+    `responses` records the (status, number of inputs) of every request.
+    """
+
+    def __init__(self, dim: int = 768, latency: float = 0.005, statuses=(), max_inputs: int = None):
+        self.vectors = np.random.default_rng(0).standard_normal((1024, dim)).astype(np.float32).round(5)
+        # Pre-serialized rows, so the server is cheap compared to the client
+        rows = [json.dumps(row.tolist()) for row in self.vectors]
+        pending_statuses = list(statuses)
+        responses = self.responses = []
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                time.sleep(latency)
+                with lock:
+                    if pending_statuses:
+                        status = pending_statuses.pop(0)
+                    elif max_inputs is not None and len(body["inputs"]) > max_inputs:
+                        status = 413
+                    else:
+                        status = 200
+                    responses.append((status, len(body["inputs"])))
+                if status != 200:
+                    self.send_response(status)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                out = ("[" + ",".join(rows[len(text) % len(rows)] for text in body["inputs"]) + "]").encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,26 +1,220 @@
+import os
+import sys
+import time
+
 import torch
 import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import metrics
+
+# Upper bound on the (rows x clusters) distance block held at once
+CHUNK_BYTES = 256 * 2**20
+
+ITERATION_SECONDS = metrics.histogram("kmeans_iteration_seconds", "Time of one KMeans iteration")
+
+
+def _chunk_rows(n_clusters, element_size, chunk_bytes=CHUNK_BYTES):
+    return max(1, chunk_bytes // (n_clusters * element_size))
+
+
+def assign(X, centers, chunk_size=None):
+    """
+    Returns (labels, squared distances to the closest center) for every row of
+    X, computing ||x||^2 - 2 x.c + ||c||^2 in row chunks so memory stays
+    bounded by CHUNK_BYTES regardless of len(X).
+    """
+    n_samples = X.shape[0]
+    chunk_size = chunk_size or _chunk_rows(centers.shape[0], X.element_size())
+    center_norms = (centers * centers).sum(dim=1)
+
+    labels = torch.empty(n_samples, dtype=torch.long, device=X.device)
+    min_dists = torch.empty(n_samples, dtype=X.dtype, device=X.device)
+    for start in range(0, n_samples, chunk_size):
+        chunk = X[start:start + chunk_size]
+        dists = torch.addmm(center_norms, chunk, centers.T, alpha=-2)
+        chunk_min, chunk_labels = dists.min(dim=1)
+        labels[start:start + chunk_size] = chunk_labels
+        # ||x||^2 is constant per row, so it is only added after the argmin
+        min_dists[start:start + chunk_size] = (chunk_min + (chunk * chunk).sum(dim=1)).clamp_(min=0)
+    return labels, min_dists
+
+
+def kmeans_plusplus(X, n_clusters, init_size=None, generator=None):
+    """
+    k-means++ seeding: each new center is drawn with probability proportional
+    to the squared distance to the closest center chosen so far. Seeding runs
+    on a random subsample of `init_size` rows to keep it cheap on large X.
+    """
+    n_samples = X.shape[0]
+    init_size = min(n_samples, init_size or max(10_000, 20 * n_clusters))
+    sample = X[torch.randperm(n_samples, generator=generator)[:init_size].to(X.device)]
+
+    centers = torch.empty((n_clusters, X.shape[1]), dtype=X.dtype, device=X.device)
+    first = torch.randint(init_size, (1,), generator=generator).item()
+    centers[0] = sample[first]
+    closest = ((sample - centers[0]) ** 2).sum(dim=1)
+    for i in range(1, n_clusters):
+        weights = closest.double().cpu()
+        if weights.sum() <= 0:
+            # Fewer distinct points than clusters: fall back to uniform picks
+            weights = torch.ones_like(weights)
+        choice = torch.multinomial(weights, 1, generator=generator).item()
+        centers[i] = sample[choice]
+        closest = torch.minimum(closest, ((sample - centers[i]) ** 2).sum(dim=1))
+    return centers
+
+
+def update_centers(X, labels, centers, chunk_size=None):
+    """
+    Recomputes every center as the mean of its rows with a single scatter-add
+    (index_add_) instead of one boolean mask per cluster. Empty clusters keep
+    their previous center.
+    """
+    n_clusters = centers.shape[0]
+    chunk_size = chunk_size or _chunk_rows(n_clusters, X.element_size())
+    sums = torch.zeros_like(centers)
+    for start in range(0, X.shape[0], chunk_size):
+        sums.index_add_(0, labels[start:start + chunk_size], X[start:start + chunk_size])
+    counts = torch.bincount(labels, minlength=n_clusters)
+    filled = counts > 0
+    new_centers = centers.clone()
+    new_centers[filled] = sums[filled] / counts[filled].unsqueeze(1).to(X.dtype)
+    return new_centers, counts
+
+
+def match_clusters(previous_centers, centers):
+    """
+    Returns the permutation `order` such that centers[order[i]] is the
+    cluster matched to previous_centers[i], found as the optimal one-to-one
+    assignment (Hungarian algorithm) on the pairwise center distances.
+    """
+    previous_centers = torch.as_tensor(previous_centers, dtype=torch.float32)
+    centers = torch.as_tensor(centers, dtype=torch.float32).to(previous_centers.device)
+    cost = torch.cdist(previous_centers, centers).cpu().numpy()
+    _, order = linear_sum_assignment(cost)
+    return order
+
+
+class KMeansEngine:
+    """
+    Lloyd or mini-batch k-means on torch tensors (CPU or GPU).
+
+    `inertia_history` holds the inertia (sum of squared distances) after every
+    iteration; in mini-batch mode it is the inertia of that iteration's batch.
+    """
+
+    def __init__(self, n_clusters, max_iter=1000, init="k-means++", batch_size=None,
+                 tol=1e-6, init_size=None, chunk_size=None, n_threads=None, seed=None,
+                 verbose=False):
+        self.n_clusters = n_clusters
+        self.max_iter = max_iter
+        self.init = init
+        self.batch_size = batch_size
+        self.tol = tol
+        self.init_size = init_size
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads
+        self.seed = seed
+        self.verbose = verbose
+
+        self.inertia_history = []
+        self.iteration_seconds = []
+        self.n_iter = 0
+
+    def _init_centers(self, X, generator):
+        # Arrays first: comparing an array with a string is elementwise
+        if isinstance(self.init, (torch.Tensor, np.ndarray)):
+            if tuple(self.init.shape) != (self.n_clusters, X.shape[1]):
+                raise ValueError(f"init has shape {tuple(self.init.shape)}, "
+                                 f"expected {(self.n_clusters, X.shape[1])}")
+            return torch.as_tensor(self.init, dtype=X.dtype, device=X.device).clone()
+        if self.init == "k-means++":
+            return kmeans_plusplus(X, self.n_clusters, self.init_size, generator)
+        if self.init == "random":
+            return X[torch.randperm(X.shape[0], generator=generator)[:self.n_clusters].to(X.device)].clone()
+        raise ValueError(f"Unknown init {self.init!r}")
+
+    def _log(self, iteration, inertia, seconds):
+        self.inertia_history.append(inertia)
+        self.iteration_seconds.append(seconds)
+        ITERATION_SECONDS.observe(seconds)
+        if self.verbose:
+            print(f"[KMeans] iter {iteration}: inertia={inertia:.6g} ({seconds:.3f}s)")
+
+    def fit(self, X):
+        if self.n_threads:
+            torch.set_num_threads(self.n_threads)
+        generator = torch.Generator()
+        if self.seed is not None:
+            generator.manual_seed(self.seed)
+        else:
+            generator.seed()
+
+        centers = self._init_centers(X, generator)
+        if self.batch_size:
+            centers = self._fit_minibatch(X, centers, generator)
+            labels, _ = assign(X, centers, self.chunk_size)
+        else:
+            labels, centers = self._fit_lloyd(X, centers)
+        return labels, centers
+
+    def _fit_lloyd(self, X, centers):
+        for iteration in range(self.max_iter):
+            start = time.perf_counter()
+            labels, min_dists = assign(X, centers, self.chunk_size)
+            new_centers, _ = update_centers(X, labels, centers, self.chunk_size)
+            self._log(iteration, min_dists.sum().item(), time.perf_counter() - start)
+            self.n_iter = iteration + 1
+
+            # Use allclose for floating point comparison
+            if torch.allclose(centers, new_centers, atol=self.tol):
+                return labels, centers
+            centers = new_centers
+        # Labels must belong to the centers that are returned
+        labels, _ = assign(X, centers, self.chunk_size)
+        return labels, centers
+
+    def _fit_minibatch(self, X, centers, generator):
+        n_samples = X.shape[0]
+        # Points seen per center so far; each center's step size is batch count / total count
+        seen = torch.zeros(self.n_clusters, dtype=X.dtype, device=X.device)
+        for iteration in range(self.max_iter):
+            start = time.perf_counter()
+            batch = X[torch.randint(n_samples, (self.batch_size,), generator=generator).to(X.device)]
+            labels, min_dists = assign(batch, centers, self.chunk_size)
+
+            sums = torch.zeros_like(centers).index_add_(0, labels, batch)
+            counts = torch.bincount(labels, minlength=self.n_clusters).to(X.dtype)
+            seen += counts
+            filled = counts > 0
+            step = (sums[filled] - counts[filled].unsqueeze(1) * centers[filled]) / seen[filled].unsqueeze(1)
+            new_centers = centers.clone()
+            new_centers[filled] += step
+
+            self._log(iteration, min_dists.sum().item(), time.perf_counter() - start)
+            self.n_iter = iteration + 1
+
+            if torch.allclose(centers, new_centers, atol=self.tol):
+                centers = new_centers
+                break
+            centers = new_centers
+        return centers
+
 
 # WARNING: AI
-def KMeans(X, n_clusters, max_iter=1000):
+def KMeans(X, n_clusters, max_iter=1000, **kwargs):
+    """
+    Clusters the rows of X and returns (labels, centers) on X's device (GPU if
+    available). Extra keyword arguments go to KMeansEngine, e.g.
+    `batch_size=4096` for mini-batch mode, `init="random"`, `n_threads=16`,
+    `verbose=True` to print the inertia of every iteration.
+    """
     # move X to GPU if available
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     if type(X) == np.ndarray:
         X = torch.from_numpy(X)
     X = X.to(device)
 
-    n_samples, n_features = X.size()
-    centers = X[torch.randperm(n_samples)[:n_clusters]].to(device)
-    for _ in range(max_iter):
-        dists = torch.cdist(X, centers)
-        labels = torch.argmin(dists, dim=1)
-        # Handle clusters with no assigned points by keeping the old center
-        new_centers = torch.stack([
-            X[labels == i].mean(dim=0) if (labels == i).any() else centers[i]
-            for i in range(n_clusters)
-        ])
-        # Use allclose for floating point comparison
-        if torch.allclose(centers, new_centers, atol=1e-6):
-            break
-        centers = new_centers
-    return labels, centers
\ No newline at end of file
+    return KMeansEngine(n_clusters, max_iter=max_iter, **kwargs).fit(X)
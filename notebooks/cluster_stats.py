@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+import torch
+
+from accelerate import CHUNK_BYTES, KMeans, match_clusters
+
+# Engagement counts, when the posts carry them
+LIKES_COLUMN = "like_count"
+REPLIES_COLUMN = "reply_count"
+
+
+def engagement_weights(dataset):
+    """
+    Returns (1 + likes) * (1 + replies) per post, or None when the dataset has
+    no engagement counts.
+    """
+    if LIKES_COLUMN not in dataset or REPLIES_COLUMN not in dataset:
+        return None
+    likes = dataset[LIKES_COLUMN].fillna(0).to_numpy(dtype=np.float32)
+    replies = dataset[REPLIES_COLUMN].fillna(0).to_numpy(dtype=np.float32)
+    return torch.from_numpy((1 + likes) * (1 + replies))
+
+
+def cluster_statistics(X, labels, centers, weights=None, chunk_size=None):
+    """
+    Computes per-cluster statistics in one pass over X with scatter
+    reductions, instead of one boolean mask per cluster.
+
+    Returns (table, weighted_centers). The table has one row per cluster with
+    its size, inertia (sum of squared distances to the center), mse (mean
+    squared error per coordinate, as torch.mean over the cluster's rows),
+    radius (largest distance to the center) and total weight.
+    weighted_centers are the centroids with every post weighted by `weights`
+    (e.g. engagement_weights), or the plain means when weights is None.
+    Empty clusters keep their center and get NaN mse and radius.
+    """
+    n_clusters, dim = centers.shape
+    chunk_size = chunk_size or max(1, CHUNK_BYTES // (dim * X.element_size()))
+    weights = torch.ones(X.shape[0], device=X.device) if weights is None else weights.to(X.device, X.dtype)
+
+    inertia = torch.zeros(n_clusters, dtype=X.dtype, device=X.device)
+    radius = torch.zeros(n_clusters, dtype=X.dtype, device=X.device)
+    weighted_sums = torch.zeros_like(centers)
+    for start in range(0, X.shape[0], chunk_size):
+        chunk = X[start:start + chunk_size]
+        chunk_labels = labels[start:start + chunk_size]
+        chunk_weights = weights[start:start + chunk_size]
+
+        squared = ((chunk - centers[chunk_labels]) ** 2).sum(dim=1)
+        inertia.index_add_(0, chunk_labels, squared)
+        radius.scatter_reduce_(0, chunk_labels, squared.sqrt(), reduce="amax")
+        weighted_sums.index_add_(0, chunk_labels, chunk * chunk_weights.unsqueeze(1))
+
+    sizes = torch.bincount(labels, minlength=n_clusters)
+    total_weight = torch.zeros(n_clusters, dtype=X.dtype, device=X.device).index_add_(0, labels, weights)
+    filled = sizes > 0
+    weighted_centers = centers.clone()
+    weighted_centers[filled] = weighted_sums[filled] / total_weight[filled].unsqueeze(1)
+
+    # a single sync for the whole table
+    sizes, inertia, radius, total_weight = (t.cpu().numpy() for t in (sizes, inertia, radius, total_weight))
+    empty = sizes == 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mse = inertia / (sizes * dim)
+    mse[empty] = np.nan
+    radius[empty] = np.nan
+
+    table = pd.DataFrame({
+        "cluster": np.arange(n_clusters),
+        "size": sizes,
+        "inertia": inertia,
+        "mse": mse,
+        "radius": radius,
+        "weight": total_weight,
+    })
+    return table, weighted_centers
+
+
+def _untimed(stage, fn):
+    return fn()
+
+
+def cluster_window(X, n_clusters, previous_means=None, weights=None, max_iter=1000, warm_start_iter=20,
+                   seed=None, timed=_untimed):
+    """
+    Clusters one window of cluster_video.py and returns (labels, means,
+    table, weighted_means), with table and weighted_means as in
+    cluster_statistics.
+
+    Given the previous window's means, KMeans starts from them for
+    `warm_start_iter` iterations (from scratch when it is None) and the
+    clusters are renumbered so cluster i continues cluster i of the previous
+    window. `timed(stage, fn)` runs every stage ("kmeans", "match",
+    "statistics"), e.g. to time it.
+    """
+    if previous_means is None or warm_start_iter is None:
+        labels, means = timed("kmeans", lambda: KMeans(X, n_clusters, max_iter=max_iter, seed=seed))
+    else:
+        labels, means = timed("kmeans", lambda: KMeans(X, n_clusters, max_iter=warm_start_iter, init=previous_means))
+    if previous_means is not None:
+        order = torch.from_numpy(timed("match", lambda: match_clusters(previous_means, means))).to(means.device)
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(n_clusters, device=order.device)
+        means = means[order]
+        labels = rank[labels]
+
+    table, weighted_means = timed("statistics", lambda: cluster_statistics(X, labels, means, weights))
+    return labels, means, table, weighted_means
+
+
+def rank_clusters(table, min_posts, count=10):
+    """
+    Returns the ids of the `count` lowest-MSE clusters with more than
+    `min_posts` posts.
+    """
+    large = table[table["size"] > min_posts]
+    return large.sort_values("mse", kind="stable")["cluster"].to_numpy()[:count]
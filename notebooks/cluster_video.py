@@ -1,102 +1,178 @@
 import pandas as pd
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import os
+import shutil
+import sys
 
 import torch
-from sklearn.decomposition import PCA
-from accelerate import KMeans
+from sklearn.decomposition import IncrementalPCA
+from cluster_stats import cluster_window, engagement_weights, rank_clusters
 from tqdm import tqdm
 
+sys.path.append('../scripts')
+from embedding_store import EmbeddingStore
+from block_loader import iter_embedding_blocks
+from metrics import JsonLogger
+
 CLUSTER_COUNT = 500
+# Same choice as accelerate.KMeans, so CPU-only nodes work too
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 MIN_POST_FILTER = 50
 FRAME_DIR = Path('../data/video_frames')
 DATA_DIR = Path('../data/embeddings')
 GROUP_SIZE = 2
-
-# Prepare directories
-FRAME_DIR.mkdir(exist_ok=True)
+# Set to a store written by load_embed.py to cluster it instead of the parquet blocks
+EMBEDDING_STORE = None
+WINDOW_ROWS = 20_000
+# Start every window's KMeans from the previous window's centroids
+WARM_START = True
+WARM_START_ITER = 20
+# Per-window centroids of every cluster, indexed by a stable cluster id
+TRAJECTORY_STORE = Path('../data/cluster_trajectories.embstore')
+# Record engagement-weighted (likes x replies) centroids instead of the KMeans means
+WEIGHTED_TRAJECTORIES = False
+# 2-D coordinates and labels per window; frames are rendered from here only
+PROJECTION_DIR = Path('../data/video_projection')
+# Recluster and reproject even if PROJECTION_DIR is complete
+RECOMPUTE = False
+RENDER_WORKERS = os.cpu_count()
+# Append KMeans iteration times etc. as JSON lines to this file (see metrics.py)
+METRICS_LOG = None
+XLIM = (-1/2, 3/4)
+YLIM = (-1/2, 3/4)
 
 # Data loader
 block_names = [f"{i:03d}.parquet" for i in range(350)]
 
 datasets = [block_names[i:i+GROUP_SIZE] for i in range(0, len(block_names), GROUP_SIZE)]
 
-def flatten(column):
-    return np.array([np.array(x) for x in column])
-
-centrioids = None
-# PCA should be shared for all datapoints
-pca = PCA(n_components=2)
-
-for dataset_number, dataset in enumerate(tqdm(datasets, desc="Processing datasets")):
-    print("Processing dataset", dataset_number)
-
-    dataset = pd.concat([pd.read_parquet(DATA_DIR / block) for block in dataset])
-
-    embedding_matrix = torch.from_numpy(flatten(dataset['embeddings'])).to('cuda:0')
-
-    class_labels, class_means = KMeans(embedding_matrix, CLUSTER_COUNT)
-
-    dataset["cluster"] = class_labels.cpu().numpy()
-
-    class_mse = np.zeros(CLUSTER_COUNT)
-    for i in range(CLUSTER_COUNT):
-        class_mse[i] = torch.mean((embedding_matrix[class_labels == i] - class_means[i])**2).cpu().numpy()
-
-    class_sizes = np.array([torch.sum(class_labels == i).cpu().numpy() for i in range(CLUSTER_COUNT)])
-
-    # filter out clusters with less than min_posts
-    if centrioids is None:
-        large_clusters = torch.from_numpy(np.array(np.where(class_sizes > MIN_POST_FILTER))).to('cuda:0')
-
-        embeddings = embedding_matrix[torch.isin(class_labels, large_clusters)]
-        class_labels = class_labels[torch.isin(class_labels, large_clusters)]
-
-        print(f"Reduced to {embeddings.shape[0]} tweets in {len(large_clusters[0])} clusters")
-
-        # lowest MSE clusters
-        class_MSE = torch.zeros(CLUSTER_COUNT) + torch.inf
-        MSE = torch.mean((embeddings - class_means[class_labels])**2, dim=1)
-        for i in large_clusters.cpu().numpy().flatten():
-            class_MSE[i] = torch.mean(MSE[class_labels == i])
-    else:
-        embeddings = embedding_matrix
-
-    # end of GPU
-    class_means = class_means.cpu().numpy()
-    class_labels = class_labels.cpu().numpy()
-    embeddings = embeddings.cpu().numpy()
-
-    if centrioids is None:
-        clusters_ranked = np.argsort(class_MSE)
-        best_clusters = clusters_ranked[0:10]
-        pca.fit(class_means)
+def load_windows():
+    """
+    Yields (metadata, embedding array) per window, either streamed from the
+    parquet blocks or as zero-copy slices of the embedding store's memmap.
+    """
+    if EMBEDDING_STORE is not None:
+        store = EmbeddingStore(str(EMBEDDING_STORE), create=False)
+        matrix = store.matrix()
+        metadata = store.metadata()
+        for start in range(0, len(store), WINDOW_ROWS):
+            yield metadata.iloc[start:start + WINDOW_ROWS].copy(), matrix[start:start + WINDOW_ROWS]
     else:
-        # for each point in centroid, find the closest class_mean
-        dists = np.zeros((centrioids.shape[0], class_means.shape[0]))
-        for i in range(centrioids.shape[0]):
-            for j in range(class_means.shape[0]):
-                dists[i, j] = np.linalg.norm(centrioids[i] - class_means[j])
-        best_clusters = np.argmin(dists, axis=1)
-
-    centrioids = class_means[best_clusters]
-
-    print(f"Best clusters: {best_clusters}")
-
-    # PCA for the top M clusters
-    pca_mean = pca.transform(class_means)
-    pca_datapoints = pca.transform(embeddings)
+        yield from iter_embedding_blocks([[DATA_DIR / block for block in dataset] for dataset in datasets])
+
+if EMBEDDING_STORE is not None:
+    window_count = -(-len(EmbeddingStore(str(EMBEDDING_STORE), create=False)) // WINDOW_ROWS)
+else:
+    window_count = len(datasets)
+
+def window_path(dataset_number):
+    return PROJECTION_DIR / f"window_{dataset_number:03d}.npz"
+
+def cluster_windows():
+    """
+    Clusters every window, writing the centroids to TRAJECTORY_STORE and the
+    labels to PROJECTION_DIR. The PCA is fitted incrementally on the centroids
+    of all windows, so one projection is shared by every frame.
+    """
+    previous_means = None
+    pca = IncrementalPCA(n_components=2)
+    # Start a fresh trajectory for every run
+    if TRAJECTORY_STORE.exists():
+        shutil.rmtree(TRAJECTORY_STORE)
+    trajectories = EmbeddingStore(str(TRAJECTORY_STORE))
+
+    for dataset_number, (dataset, embedding_array) in enumerate(tqdm(load_windows(), total=window_count, desc="Clustering datasets")):
+        embedding_matrix = torch.from_numpy(np.asarray(embedding_array)).to(DEVICE, dtype=torch.float32)
+
+        # cluster i continues cluster i of the previous window
+        class_labels, class_means, stats, weighted_means = cluster_window(
+            embedding_matrix, CLUSTER_COUNT, previous_means, engagement_weights(dataset),
+            warm_start_iter=WARM_START_ITER if WARM_START else None)
+        previous_means = class_means
+
+        trajectories.append((weighted_means if WEIGHTED_TRAJECTORIES else class_means).cpu().numpy(), pd.DataFrame({
+            "window": dataset_number,
+            "cluster": stats["cluster"],
+            "size": stats["size"],
+            "mse": stats["mse"],
+            "radius": stats["radius"],
+        }))
+
+        # cluster ids are stable across windows, so the best clusters are picked once
+        if dataset_number == 0:
+            # lowest MSE clusters among those with more than MIN_POST_FILTER posts
+            large_clusters = stats[stats["size"] > MIN_POST_FILTER]
+            print(f"Reduced to {large_clusters['size'].sum()} tweets in {len(large_clusters)} clusters")
+
+            best_clusters = rank_clusters(stats, MIN_POST_FILTER)
+            np.save(PROJECTION_DIR / "best_clusters.npy", best_clusters)
+            print(f"Best clusters: {best_clusters}")
+
+        pca.partial_fit(class_means.cpu().numpy())
+        np.save(PROJECTION_DIR / f"labels_{dataset_number:03d}.npy", class_labels.cpu().numpy().astype(np.int32))
+
+    return pca, trajectories
+
+def project_windows(pca, trajectories):
+    """
+    Projects every post and centroid once with the shared PCA and caches the
+    2-D coordinates per window.
+    """
+    components = torch.from_numpy(pca.components_.T.astype(np.float32)).to(DEVICE)
+    pca_offset = torch.from_numpy(pca.mean_.astype(np.float32)).to(DEVICE)
+    centroids = trajectories.matrix().reshape(-1, CLUSTER_COUNT, trajectories.dim)
+
+    for dataset_number, (dataset, embedding_array) in enumerate(tqdm(load_windows(), total=window_count, desc="Projecting datasets")):
+        embedding_matrix = torch.from_numpy(np.asarray(embedding_array)).to(DEVICE, dtype=torch.float32)
+        pca_datapoints = ((embedding_matrix - pca_offset) @ components).cpu().numpy()
+        pca_mean = pca.transform(centroids[dataset_number])
+
+        labels_path = PROJECTION_DIR / f"labels_{dataset_number:03d}.npy"
+        np.savez(window_path(dataset_number), points=pca_datapoints, labels=np.load(labels_path), means=pca_mean)
+        labels_path.unlink()
+
+def render_frame(dataset_number):
+    """
+    Draws one frame from the cached projection only.
+    """
+    best_clusters = np.load(PROJECTION_DIR / "best_clusters.npy")
+    with np.load(window_path(dataset_number)) as window:
+        pca_datapoints, class_labels, pca_mean = window["points"], window["labels"], window["means"]
 
     cmap = plt.get_cmap('jet')
 
-    plt.figure()
+    fig = plt.figure()
     for i in range(len(best_clusters)):
         plt.scatter(pca_mean[best_clusters[i], 0], pca_mean[best_clusters[i], 1], color=cmap(i/len(best_clusters)), marker='x')
 
         pca_class_datapoints = pca_datapoints[class_labels == best_clusters[i]]
-        print(f"Class {best_clusters[i]}: {pca_class_datapoints.shape[0]} tweets")
         plt.scatter(pca_class_datapoints[:, 0], pca_class_datapoints[:, 1], color=cmap(i/len(best_clusters)), alpha=0.1)
-        plt.xlim(-1/2, 3/4)
-        plt.ylim(-1/2, 3/4)
-    plt.savefig(FRAME_DIR / f"frame_{dataset_number:03d}.png")
+        plt.xlim(*XLIM)
+        plt.ylim(*YLIM)
+    fig.savefig(FRAME_DIR / f"frame_{dataset_number:03d}.png")
+    plt.close(fig)
+
+if __name__ == "__main__":
+    # Prepare directories
+    FRAME_DIR.mkdir(exist_ok=True)
+    PROJECTION_DIR.mkdir(exist_ok=True)
+
+    metrics_logger = JsonLogger(METRICS_LOG).start() if METRICS_LOG is not None else None
+
+    cached = (PROJECTION_DIR / "best_clusters.npy").exists() and all(window_path(n).exists() for n in range(window_count))
+    if RECOMPUTE or not cached:
+        pca, trajectories = cluster_windows()
+        project_windows(pca, trajectories)
+    else:
+        print(f"Rendering from the cached projection in {PROJECTION_DIR}")
+
+    with ProcessPoolExecutor(max_workers=RENDER_WORKERS) as pool:
+        list(tqdm(pool.map(render_frame, range(window_count)), total=window_count, desc="Rendering frames"))
+
+    if metrics_logger is not None:
+        metrics_logger.stop()
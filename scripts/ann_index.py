@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+ann_index.py
+
+Persistent approximate nearest-neighbor index (IVF-PQ) over post embeddings.
+
+Vectors are assigned to the closest of `n_lists` coarse centroids (the
+inverted file), and their residual to that centroid is compressed by product
+quantization into `n_subvectors` one-byte codes. A query is compared only
+against the vectors of its `n_probe` closest lists, with distances looked up
+from per-subvector tables (asymmetric distance computation). This makes
+top-k search sub-linear and keeps the index at n_subvectors bytes per post.
+
+An index is a directory holding
+  - `quantizer.npz`: coarse centroids and PQ codebooks (fixed after training),
+  - `segments/seg-<first id>.npz`: ids, list assignments and codes of one
+    insert, e.g. one day or one embedding block,
+  - `index.json`: the configuration and the committed segments with their
+    tags, replaced atomically after a segment is on disk.
+
+Built incrementally from the embedding blocks with:
+    python ann_index.py --index ../data/ann_index --blocks_dir ../data/embeddings
+
+Only blocks whose name is not yet a segment tag are added.
+"""
+
+import argparse as ap
+import json
+import os
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+from block_loader import iter_embedding_blocks
+
+QUANTIZER_FILE = "quantizer.npz"
+SEGMENT_DIR = "segments"
+HEADER_FILE = "index.json"
+# One byte per subvector code
+N_CODES = 256
+TRAIN_SIZE = 100_000
+
+
+def _squared_distances(X, centers):
+    return (X * X).sum(axis=1)[:, None] - 2 * X @ centers.T + (centers * centers).sum(axis=1)[None, :]
+
+
+class IVFPQIndex:
+    def __init__(self, path: str, n_lists: int = 1024, n_subvectors: int = 64):
+        """
+        Opens the index at `path`, creating an empty, untrained one when it
+        does not exist yet. `n_lists` and `n_subvectors` only apply to a new
+        index.
+        """
+        self.path = path
+        self.header_path = os.path.join(path, HEADER_FILE)
+        self.quantizer_path = os.path.join(path, QUANTIZER_FILE)
+        self.segment_dir = os.path.join(path, SEGMENT_DIR)
+
+        if os.path.exists(self.header_path):
+            with open(self.header_path) as f:
+                header = json.load(f)
+            self.dim = header["dim"]
+            self.n_lists = header["n_lists"]
+            self.n_subvectors = header["n_subvectors"]
+            self.segments = header["segments"]
+        else:
+            os.makedirs(self.segment_dir, exist_ok=True)
+            self.dim = None
+            self.n_lists = n_lists
+            self.n_subvectors = n_subvectors
+            self.segments = []
+            self._write_header()
+
+        self.coarse = None
+        self.codebooks = None
+        if os.path.exists(self.quantizer_path):
+            with np.load(self.quantizer_path) as f:
+                self.coarse = f["coarse"]
+                self.codebooks = f["codebooks"]
+
+        # Inverted lists, rebuilt from the segments on the first search
+        self._lists = None
+        self._codebook_norms = None
+
+    def __len__(self) -> int:
+        return sum(segment["rows"] for segment in self.segments)
+
+    @property
+    def is_trained(self) -> bool:
+        return self.coarse is not None
+
+    @property
+    def tags(self) -> set:
+        return {segment["tag"] for segment in self.segments}
+
+    def _write_header(self):
+        tmp_path = self.header_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self.dim, "n_lists": self.n_lists,
+                       "n_subvectors": self.n_subvectors, "segments": self.segments}, f)
+        os.replace(tmp_path, self.header_path)
+
+    def _subvectors(self, X) -> np.ndarray:
+        return X.reshape(len(X), self.n_subvectors, self.dim // self.n_subvectors)
+
+    def train(self, sample: np.ndarray, seed: int = 0):
+        """
+        Learns the coarse centroids and the PQ codebooks from a sample of the
+        vectors (at least N_CODES, ideally 40 * n_lists rows).
+        """
+        if self.is_trained:
+            raise ValueError("Index is already trained")
+        sample = np.ascontiguousarray(sample, dtype=np.float32)
+        if len(sample) < N_CODES:
+            # Fewer rows would leave codewords at zero that encode() still picks
+            raise ValueError(f"Need at least {N_CODES} training vectors, got {len(sample)}")
+        dim = sample.shape[1]
+        if dim % self.n_subvectors:
+            raise ValueError(f"Dimension {dim} is not divisible by n_subvectors={self.n_subvectors}")
+        self.dim = dim
+        self.n_lists = min(self.n_lists, len(sample))
+
+        coarse = MiniBatchKMeans(self.n_lists, batch_size=4096, n_init=1, random_state=seed).fit(sample)
+        self.coarse = coarse.cluster_centers_.astype(np.float32)
+        residuals = self._subvectors(sample - self.coarse[coarse.labels_])
+
+        self.codebooks = np.empty((self.n_subvectors, N_CODES, residuals.shape[2]), dtype=np.float32)
+        for j in range(self.n_subvectors):
+            self.codebooks[j] = KMeans(N_CODES, n_init=1, max_iter=20, random_state=seed).fit(
+                residuals[:, j]).cluster_centers_
+
+        tmp_path = self.quantizer_path + ".tmp.npz"
+        np.savez(tmp_path, coarse=self.coarse, codebooks=self.codebooks)
+        os.replace(tmp_path, self.quantizer_path)
+        self._codebook_norms = None
+        self._write_header()
+
+    def encode(self, X: np.ndarray):
+        """
+        Returns (list assignment, PQ codes) of every row of X.
+        """
+        lists = _squared_distances(X, self.coarse).argmin(axis=1)
+        residuals = self._subvectors(X - self.coarse[lists])
+        codes = np.empty((len(X), self.n_subvectors), dtype=np.uint8)
+        for j in range(self.n_subvectors):
+            codes[:, j] = _squared_distances(residuals[:, j], self.codebooks[j]).argmin(axis=1)
+        return lists.astype(np.int32), codes
+
+    def add(self, vectors: np.ndarray, tag: str) -> np.ndarray:
+        """
+        Adds `vectors` as one segment labelled `tag` (e.g. a day or a block
+        name) and returns their ids: consecutive integers after the ones
+        already in the index, so `locate` can map them back to a segment row.
+        """
+        if not self.is_trained:
+            raise ValueError("Train the index before adding vectors")
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected an (n, {self.dim}) matrix")
+        first_id = max((segment["first_id"] + segment["rows"] for segment in self.segments), default=0)
+        ids = np.arange(first_id, first_id + len(vectors), dtype=np.int64)
+
+        lists, codes = self.encode(vectors)
+        name = f"seg-{first_id:012d}.npz"
+        tmp_path = os.path.join(self.segment_dir, name + ".tmp.npz")
+        np.savez(tmp_path, ids=ids, lists=lists, codes=codes)
+        os.replace(tmp_path, os.path.join(self.segment_dir, name))
+
+        self.segments.append({"file": name, "tag": tag, "first_id": first_id, "rows": len(vectors)})
+        self._write_header()
+        self._lists = None
+        return ids
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            ids, lists, codes, segment_numbers = [], [], [], []
+            for number, segment in enumerate(self.segments):
+                with np.load(os.path.join(self.segment_dir, segment["file"])) as f:
+                    ids.append(f["ids"])
+                    lists.append(f["lists"])
+                    codes.append(f["codes"])
+                segment_numbers.append(np.full(segment["rows"], number, dtype=np.int32))
+            if ids:
+                lists = np.concatenate(lists)
+                order = np.argsort(lists, kind="stable")
+                offsets = np.searchsorted(lists[order], np.arange(self.n_lists + 1))
+                self._lists = (offsets, np.concatenate(ids)[order], np.concatenate(codes)[order],
+                               np.concatenate(segment_numbers)[order])
+            else:
+                self._lists = (np.zeros(self.n_lists + 1, dtype=np.int64), np.empty(0, dtype=np.int64),
+                               np.empty((0, self.n_subvectors), dtype=np.uint8), np.empty(0, dtype=np.int32))
+        return self._lists
+
+    def search(self, queries: np.ndarray, k: int = 10, n_probe: int = 16, tags: list = None):
+        """
+        Returns (squared distances, ids), both (n_queries x k), of the
+        approximate k nearest neighbors of every query, optionally only among
+        segments with one of `tags`. Missing neighbors have id -1.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        offsets, ids, codes, segment_numbers = self._inverted_lists()
+        allowed = None
+        if tags is not None:
+            allowed = np.array([segment["tag"] in set(tags) for segment in self.segments], dtype=bool)
+
+        n_probe = min(n_probe, self.n_lists)
+        probes = np.argpartition(_squared_distances(queries, self.coarse), n_probe - 1, axis=1)[:, :n_probe]
+        subvector_index = np.arange(self.n_subvectors)
+        if self._codebook_norms is None:
+            self._codebook_norms = (self.codebooks * self.codebooks).sum(axis=2)
+
+        result_dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+        result_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, (query, probe) in enumerate(zip(queries, probes)):
+            # Distance tables between the query residual and every codeword, per probed list
+            residuals = self._subvectors(query[None, :] - self.coarse[probe])
+            tables = ((residuals * residuals).sum(axis=2)[:, :, None]
+                      - 2 * np.einsum("pmd,mcd->pmc", residuals, self.codebooks)
+                      + self._codebook_norms[None])
+
+            starts, ends = offsets[probe], offsets[probe + 1]
+            candidates = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+            probe_of = np.repeat(np.arange(n_probe), ends - starts)
+            if allowed is not None:
+                keep = allowed[segment_numbers[candidates]]
+                candidates, probe_of = candidates[keep], probe_of[keep]
+            if len(candidates) == 0:
+                continue
+            dists = tables[probe_of[:, None], subvector_index[None, :], codes[candidates]].sum(axis=1)
+
+            top = min(k, len(candidates))
+            best = np.argpartition(dists, top - 1)[:top]
+            best = best[np.argsort(dists[best])]
+            result_dists[q, :top] = dists[best]
+            result_ids[q, :top] = ids[candidates[best]]
+        return result_dists, result_ids
+
+    def locate(self, ids: np.ndarray) -> list:
+        """
+        Returns (tag, row within the segment) of ids assigned by `add`, and
+        None for the -1 that `search` pads missing neighbors with.
+        """
+        ids = np.asarray(ids)
+        first_ids = np.array([segment["first_id"] for segment in self.segments])
+        numbers = np.searchsorted(first_ids, ids, side="right") - 1
+        return [(self.segments[n]["tag"], int(i - first_ids[n])) if i >= 0 else None
+                for n, i in zip(numbers, ids)]
+
+
+def index_blocks(index: IVFPQIndex, blocks_dir: str, train_size: int = TRAIN_SIZE):
+    """
+    Adds every block in `blocks_dir` that is not yet in the index, training
+    the index on the first blocks if needed.
+    """
+    names = sorted(name for name in os.listdir(blocks_dir) if name.endswith(".parquet"))
+    if not index.is_trained:
+        sample, rows = [], 0
+        for _, matrix in iter_embedding_blocks([os.path.join(blocks_dir, name) for name in names]):
+            sample.append(matrix)
+            rows += len(matrix)
+            if rows >= train_size:
+                break
+        if not sample:
+            raise ValueError(f"No embedding blocks found in {blocks_dir}")
+        print(f"Training on {min(rows, train_size)} vectors...")
+        index.train(np.concatenate(sample)[:train_size])
+
+    new_names = [name for name in names if name not in index.tags]
+    paths = [os.path.join(blocks_dir, name) for name in new_names]
+    for name, (_, matrix) in zip(new_names, iter_embedding_blocks(paths)):
+        index.add(matrix, tag=name)
+        print(f"Indexed {name}: {len(matrix)} posts ({len(index)} total)")
+
+
+if __name__ == "__main__":
+    arg_parser = ap.ArgumentParser(description="Build or extend the IVF-PQ index over the embedding blocks.")
+    arg_parser.add_argument("--index", type=str, default="../data/ann_index",
+                            help="Directory of the index.")
+    arg_parser.add_argument("--blocks_dir", type=str, default="../data/embeddings",
+                            help="Directory of the embedding blocks to add.")
+    arg_parser.add_argument("--n_lists", type=int, default=1024,
+                            help="Number of inverted lists of a new index.")
+    arg_parser.add_argument("--n_subvectors", type=int, default=64,
+                            help="Bytes per vector of a new index; must divide the dimension.")
+    arg_parser.add_argument("--train_size", type=int, default=TRAIN_SIZE,
+                            help="Number of vectors to train a new index on.")
+    args = arg_parser.parse_args()
+
+    index_blocks(IVFPQIndex(args.index, args.n_lists, args.n_subvectors), args.blocks_dir, args.train_size)
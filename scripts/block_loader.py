@@ -0,0 +1,120 @@
+"""
+block_loader.py
+
+Streaming reader for the embedding blocks written by embed.ipynb
+(data/embeddings/NNN.parquet).
+
+The `embeddings` list column is turned into a 2-D float32 matrix straight
+from its Arrow child values instead of going through one NumPy array per row.
+The values are viewed without a copy when they are already float32 (and cast
+once otherwise). Blocks are read by a background thread, which stays at most
+`prefetch` chunks ahead of the consumer. Memory therefore stays bounded by a
+few chunks, however many blocks are streamed.
+"""
+
+import os
+import queue
+import threading
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+EMBEDDING_COLUMN = "embeddings"
+_DONE = object()
+
+
+def embedding_matrix(column) -> np.ndarray:
+    """
+    Returns the (rows x dim) float32 matrix of a list or fixed-size-list
+    column (Array or ChunkedArray) whose rows all have the same length.
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks() if column.num_chunks != 1 else column.chunk(0)
+    if len(column) == 0:
+        return np.empty((0, 0), dtype=np.float32)
+    if column.null_count:
+        raise ValueError("Embedding column contains null rows")
+
+    if pa.types.is_fixed_size_list(column.type):
+        dim = column.type.list_size
+    else:
+        offsets = column.offsets.to_numpy()
+        lengths = np.diff(offsets)
+        dim = int(lengths[0])
+        if not (lengths == dim).all():
+            raise ValueError("Embeddings in one block must all have the same dimension")
+
+    # flatten() honours the array's offset, so slices are handled too
+    values = column.flatten()
+    if values.type != pa.float32():
+        values = values.cast(pa.float32())
+    return values.to_numpy(zero_copy_only=values.null_count == 0).reshape(-1, dim)
+
+
+def _read_chunks(paths, columns, chunk_rows):
+    """
+    Yields Arrow tables covering `paths` in order: one per group of paths
+    when chunk_rows is None, or slices of at most `chunk_rows` rows otherwise.
+    """
+    if chunk_rows is None:
+        yield pa.concat_tables([pq.read_table(path, columns=columns) for path in paths])
+        return
+    for path in paths:
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns):
+            yield pa.Table.from_batches([batch])
+
+
+def iter_embedding_blocks(groups, chunk_rows: int = None, columns: list = None, prefetch: int = 2):
+    """
+    Yields (metadata DataFrame, embedding matrix) for every group of block
+    paths in `groups` (a path or a list of paths each). With `chunk_rows`
+    set, each group is split into chunks of at most that many rows.
+
+    Reading and decoding happen on a background thread, up to `prefetch`
+    chunks ahead of the consumer.
+    """
+    if columns is not None and EMBEDDING_COLUMN not in columns:
+        columns = list(columns) + [EMBEDDING_COLUMN]
+
+    chunks = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up when the consumer has stopped iterating
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for group in groups:
+                paths = [group] if isinstance(group, (str, os.PathLike)) else list(group)
+                for table in _read_chunks(paths, columns, chunk_rows):
+                    matrix = embedding_matrix(table.column(EMBEDDING_COLUMN))
+                    metadata = table.drop_columns([EMBEDDING_COLUMN]).to_pandas()
+                    if not put((metadata, matrix)):
+                        return
+        except BaseException as e:
+            put(e)
+            return
+        put(_DONE)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+dedup_filter.py
+
+Collapses near-duplicate posts (bot floods, copy-paste campaigns, reposted
+quotes) into one representative with a multiplicity count, before they are
+embedded and clustered.
+
+Texts are normalized (lowercased, whitespace collapsed), cut into byte
+shingles and summarized by a MinHash signature. Signatures are computed for a
+whole batch at once with NumPy. An LSH index over bands of the signature
+proposes candidates, and a text joins the candidate representative whose
+estimated Jaccard similarity is at least `threshold`. Otherwise it becomes a
+new representative. The index only holds representatives, so day files can
+be streamed through it in batches.
+
+Over scraped day files:
+    python dedup_filter.py --start_day 2025-01-20 --end_day 2025-01-22
+writes the representatives with a `multiplicity` column to
+../data/deduped_<start_day>_<end_day>.parquet.
+load_embed.py applies the same filter to its window with --dedup.
+
+Command-line arguments:
+  --start_day / --end_day (inclusive range of day files in ../data/)
+  --threshold             (estimated Jaccard similarity to count as duplicate)
+  --batch_size            (posts per signature batch)
+"""
+
+import argparse as ap
+import os
+import re
+from datetime import date, timedelta
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+NUM_PERM = 64
+BANDS = 16
+THRESHOLD = 0.8
+SHINGLE_SIZE = 5
+BATCH_SIZE = 10_000
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize(text: str) -> str:
+    return WHITESPACE.sub(" ", (text or "").lower()).strip()
+
+
+class NearDuplicateFilter:
+    def __init__(self, num_perm: int = NUM_PERM, bands: int = BANDS, threshold: float = THRESHOLD,
+                 shingle_size: int = SHINGLE_SIZE, seed: int = 0):
+        if num_perm % bands:
+            raise ValueError(f"num_perm={num_perm} must be a multiple of bands={bands}")
+        if not 1 <= shingle_size <= 8:
+            raise ValueError("Shingles are packed into 64 bits, so shingle_size must be 1..8")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashes; odd multipliers keep them bijective mod 2^64
+        self._mul = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self._add = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+
+        self._tables = [{} for _ in range(bands)]
+        self._signatures = np.empty((0, num_perm), dtype=np.uint32)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def counts(self) -> np.ndarray:
+        """
+        Multiplicity of every representative, indexed by representative id.
+        """
+        return self._counts[:self._size]
+
+    def signatures(self, texts: list) -> np.ndarray:
+        """
+        Returns the (len(texts), num_perm) MinHash signatures of `texts`.
+        """
+        k = self.shingle_size
+        encoded = [normalize(text).encode().ljust(k, b"\0") for text in texts]
+        lengths = np.array([len(b) for b in encoded], dtype=np.int64)
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64)
+
+        # Every k-byte window packed into one integer; windows crossing into
+        # the next text are dropped
+        windows = len(data) - k + 1
+        shingles = np.zeros(windows, dtype=np.uint64)
+        for j in range(k):
+            shingles |= data[j:j + windows] << np.uint64(8 * j)
+        counts = lengths - k + 1
+        text_of = np.repeat(np.arange(len(texts)), lengths)[:windows]
+        within = np.arange(windows) - (np.cumsum(lengths) - lengths)[text_of]
+        shingles = shingles[within < counts[text_of]]
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+
+        result = np.empty((len(texts), self.num_perm), dtype=np.uint32)
+        for p in range(self.num_perm):
+            hashed = (shingles * self._mul[p] + self._add[p]) >> np.uint64(32)
+            result[:, p] = np.minimum.reduceat(hashed, offsets)
+        return result
+
+    def _grow(self):
+        capacity = max(1024, 2 * len(self._counts))
+        signatures = np.empty((capacity, self.num_perm), dtype=np.uint32)
+        signatures[:self._size] = self._signatures[:self._size]
+        counts = np.zeros(capacity, dtype=np.int64)
+        counts[:self._size] = self._counts[:self._size]
+        self._signatures, self._counts = signatures, counts
+
+    def add(self, texts: list) -> np.ndarray:
+        """
+        Assigns every text to a representative and returns their ids. Texts
+        without a near duplicate among the representatives become new ones.
+        """
+        signatures = self.signatures(texts)
+        assigned = np.empty(len(texts), dtype=np.int64)
+        for position, signature in enumerate(signatures):
+            keys = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+            candidates = {table[key] for table, key in zip(self._tables, keys) if key in table}
+
+            best = -1
+            if candidates:
+                candidates = np.fromiter(candidates, dtype=np.int64)
+                similarity = (self._signatures[candidates] == signature).mean(axis=1)
+                if similarity.max() >= self.threshold:
+                    best = candidates[similarity.argmax()]
+
+            if best < 0:
+                if self._size == len(self._counts):
+                    self._grow()
+                best = self._size
+                self._signatures[best] = signature
+                self._size += 1
+                for table, key in zip(self._tables, keys):
+                    table.setdefault(key, best)
+            self._counts[best] += 1
+            assigned[position] = best
+        return assigned
+
+
+def _new_representatives(ids: np.ndarray, before: int) -> np.ndarray:
+    """
+    Returns the positions in `ids` where a representative numbered `before`
+    or higher occurs for the first time, in order.
+    """
+    new_ids, first = np.unique(ids, return_index=True)
+    return np.sort(first[new_ids >= before])
+
+
+def collapse_near_duplicates(texts: list, batch_size: int = BATCH_SIZE, **kwargs):
+    """
+    Returns (positions of the representative texts, their multiplicities).
+    Each representative is the first occurrence of its group.
+    """
+    dedup = NearDuplicateFilter(**kwargs)
+    first_position = []
+    for start in range(0, len(texts), batch_size):
+        before = len(dedup)
+        ids = dedup.add(texts[start:start + batch_size])
+        first_position.extend((start + _new_representatives(ids, before)).tolist())
+    return np.asarray(first_position, dtype=np.int64), dedup.counts.copy()
+
+
+def dedup_days(data_dir: str, days: list, batch_size: int = BATCH_SIZE, **kwargs) -> pa.Table:
+    """
+    Streams the day files of `days` through one filter and returns the
+    representative posts with a `multiplicity` column.
+    """
+    dedup = NearDuplicateFilter(**kwargs)
+    representatives = []
+    for day in days:
+        path = os.path.join(data_dir, f"{day}.parquet")
+        if not os.path.exists(path):
+            print(f"Skipping {day}: no day file")
+            continue
+        posts = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+            before = len(dedup)
+            ids = dedup.add(batch.column("text").to_pylist())
+            representatives.append(pa.Table.from_batches([batch]).take(_new_representatives(ids, before)))
+            posts += batch.num_rows
+        print(f"{day}: {posts} posts, {len(dedup)} representatives so far")
+
+    if not representatives:
+        return pa.table({"multiplicity": pa.array([], type=pa.int64())})
+    table = pa.concat_tables(representatives, promote_options="default")
+    return table.append_column("multiplicity", pa.array(dedup.counts))
+
+
+if __name__ == "__main__":
+    arg_parser = ap.ArgumentParser(description="Collapse near-duplicate posts of the scraped day files.")
+    arg_parser.add_argument("--start_day", type=str, required=True,
+                            help="First day file, e.g. '2025-01-20'.")
+    arg_parser.add_argument("--end_day", type=str, default=None,
+                            help="Last day file (inclusive); defaults to --start_day.")
+    arg_parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                            help="Estimated Jaccard similarity at which posts count as duplicates.")
+    arg_parser.add_argument("--batch_size", type=int, default=BATCH_SIZE,
+                            help="Posts per signature batch.")
+    args = arg_parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    data_dir = os.path.join(script_dir, "..", "data")
+    first = date.fromisoformat(args.start_day)
+    last = date.fromisoformat(args.end_day or args.start_day)
+    days = [(first + timedelta(days=n)).isoformat() for n in range((last - first).days + 1)]
+
+    table = dedup_days(data_dir, days, args.batch_size, threshold=args.threshold)
+    output_path = os.path.join(data_dir, f"deduped_{days[0]}_{days[-1]}.parquet")
+    pq.write_table(table, output_path)
+    total = int(table.column("multiplicity").to_numpy().sum())
+    print(f"Kept {table.num_rows} of {total} posts; wrote {output_path}")
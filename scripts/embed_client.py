@@ -0,0 +1,182 @@
+"""
+embed_client.py
+
+Concurrent client for a text-embeddings-inference (TEI) style endpoint, as
+used by load_embed.py.
+
+  - Texts are packed into batches up to a token budget (`max_batch_tokens`,
+    matching the server's MAX_BATCH_TOKENS) instead of a fixed batch size.
+  - `concurrency` batches are in flight at once, so the server can fill its
+    GPU batches (TEI accepts up to MAX_CONCURRENT_REQUESTS).
+  - 429 and 5xx responses (and dropped connections) are retried with
+    exponential backoff; a 413 splits the batch in half.
+  - Throughput (posts/s, tokens/s) is tracked and printed periodically;
+    request latency, batch fill and retries go to the metrics registry.
+
+Token counts are estimated from the character length, which is enough to
+keep batches under the server's limit without loading a tokenizer.
+"""
+
+import asyncio
+import json
+import random
+import time
+
+import httpx
+import numpy as np
+
+import metrics
+
+# Rough characters per token for English social media text
+CHARS_PER_TOKEN = 4
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+REQUEST_SECONDS = metrics.histogram("embed_request_seconds", "Latency of one embedding request, failed ones included")
+BATCH_FILL = metrics.histogram("embed_batch_fill", "Texts per batch as a fraction of max_batch_size",
+                               buckets=metrics.RATIO_BUCKETS)
+BATCH_TOKEN_FILL = metrics.histogram("embed_batch_token_fill", "Estimated tokens per batch as a fraction of max_batch_tokens",
+                                     buckets=metrics.RATIO_BUCKETS)
+REQUESTS_IN_FLIGHT = metrics.gauge("embed_requests_in_flight", "Embedding requests awaiting a response")
+RETRIES = metrics.counter("embed_retries_total", "Embedding requests retried")
+POSTS_EMBEDDED = metrics.counter("embed_posts_total", "Texts embedded")
+TOKENS_EMBEDDED = metrics.counter("embed_tokens_total", "Estimated tokens embedded")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def make_batches(indices, texts, max_batch_tokens: int, max_batch_size: int) -> list:
+    """
+    Packs texts into batches whose estimated token count stays under
+    `max_batch_tokens` and whose size stays under `max_batch_size`.
+    Returns a list of (indices, texts, tokens) tuples, in input order.
+    """
+    batches = []
+    batch_indices, batch_texts, batch_tokens = [], [], 0
+    for index, text in zip(indices, texts):
+        tokens = estimate_tokens(text)
+        if batch_texts and (batch_tokens + tokens > max_batch_tokens
+                            or len(batch_texts) >= max_batch_size):
+            batches.append((batch_indices, batch_texts, batch_tokens))
+            batch_indices, batch_texts, batch_tokens = [], [], 0
+        batch_indices.append(index)
+        batch_texts.append(text)
+        batch_tokens += tokens
+    if batch_texts:
+        batches.append((batch_indices, batch_texts, batch_tokens))
+    return batches
+
+
+class ThroughputStats:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.posts = 0
+        self.tokens = 0
+        self.requests = 0
+        self.retries = 0
+
+    def add(self, posts: int, tokens: int):
+        self.posts += posts
+        self.tokens += tokens
+        self.requests += 1
+
+    def report(self) -> dict:
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        return {
+            "posts": self.posts,
+            "requests": self.requests,
+            "retries": self.retries,
+            "elapsed_s": round(elapsed, 2),
+            "posts_per_s": round(self.posts / elapsed, 1),
+            "tokens_per_s": round(self.tokens / elapsed, 1),
+        }
+
+
+class EmbeddingClient:
+    def __init__(self, url: str, token: str = None, concurrency: int = 32,
+                 max_batch_tokens: int = 16_384, max_batch_size: int = 256,
+                 max_retries: int = 8, timeout: float = 120.0, report_interval: float = 30.0):
+        self.url = url
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+        self.concurrency = concurrency
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.stats = ThroughputStats()
+
+    async def _request(self, client: httpx.AsyncClient, texts: list) -> httpx.Response:
+        REQUESTS_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            return await client.post(self.url, json={"inputs": texts, "truncate": True})
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start)
+            REQUESTS_IN_FLIGHT.dec()
+
+    async def _post(self, client: httpx.AsyncClient, texts: list) -> np.ndarray:
+        """
+        Embeds one batch, retrying transient failures. A 413 (batch too large
+        for the server) is answered by embedding both halves separately.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._request(client, texts)
+            except (httpx.TransportError, httpx.TimeoutException) as e:
+                error = e
+            else:
+                if response.status_code == 413 and len(texts) > 1:
+                    half = len(texts) // 2
+                    first = await self._post(client, texts[:half])
+                    second = await self._post(client, texts[half:])
+                    return np.concatenate([first, second])
+                if response.status_code not in RETRY_STATUS:
+                    response.raise_for_status()
+                    return np.asarray(json.loads(response.content), dtype=np.float32)
+                error = httpx.HTTPStatusError(f"status {response.status_code}",
+                                              request=response.request, response=response)
+
+            if attempt == self.max_retries:
+                raise error
+            self.stats.retries += 1
+            RETRIES.inc()
+            # Exponential backoff with jitter, capped at a minute
+            await asyncio.sleep(min(60.0, 2 ** attempt) * random.uniform(0.5, 1.0))
+
+    async def _run(self, batches: list, on_batch):
+        batch_iter = iter(batches)
+        last_report = time.perf_counter()
+
+        async with httpx.AsyncClient(headers=self.headers, timeout=self.timeout,
+                                     limits=httpx.Limits(max_connections=self.concurrency)) as client:
+            async def worker():
+                nonlocal last_report
+                # The iterator is shared; the event loop never switches inside next()
+                for indices, texts, tokens in batch_iter:
+                    BATCH_FILL.observe(len(texts) / self.max_batch_size)
+                    BATCH_TOKEN_FILL.observe(tokens / self.max_batch_tokens)
+                    embeddings = await self._post(client, texts)
+                    self.stats.add(len(texts), tokens)
+                    POSTS_EMBEDDED.inc(len(texts))
+                    TOKENS_EMBEDDED.inc(tokens)
+                    on_batch(indices, embeddings)
+
+                    now = time.perf_counter()
+                    if now - last_report >= self.report_interval:
+                        last_report = now
+                        print(f"[Embedding] {self.stats.report()}")
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+    def embed(self, indices, texts, on_batch) -> dict:
+        """
+        Embeds `texts` and calls `on_batch(batch_indices, embeddings)` for
+        every finished batch, in completion order (not input order).
+        Returns the final throughput report.
+        """
+        batches = make_batches(indices, texts, self.max_batch_tokens, self.max_batch_size)
+        self.stats = ThroughputStats()
+        asyncio.run(self._run(batches, on_batch))
+        return self.stats.report()
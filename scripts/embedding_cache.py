@@ -0,0 +1,174 @@
+"""
+embedding_cache.py
+
+Persistent content-hash cache of embeddings.
+
+Entries are keyed by a hash of (model id, text), where the text is what is
+actually sent to the model (i.e. after `safe_text`). Identical texts, such as
+reposted quotes, bot spam or "gm" posts, are therefore embedded once and then
+fanned back out to every row that carries them, across runs and overlapping
+time windows. The cache lives in a single SQLite file. Once it outgrows
+`max_bytes`, the least recently used entries are evicted.
+"""
+
+import hashlib
+import sqlite3
+
+import numpy as np
+
+GB = 10**9
+# SQLite's default limit on bound parameters is 999
+QUERY_CHUNK = 500
+# Fraction of the entries dropped per eviction round
+EVICT_FRACTION = 0.1
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, model_id: str, max_bytes: int = 8 * GB):
+        self.path = path
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key BLOB PRIMARY KEY, vector BLOB NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+        self.db.commit()
+
+        self.total_bytes, self.entries, clock = self.db.execute(
+            "SELECT COALESCE(SUM(LENGTH(vector)), 0), COUNT(*), COALESCE(MAX(last_used), 0) FROM cache"
+        ).fetchone()
+        self._clock = clock
+
+        self.hits = 0
+        self.misses = 0
+        self.duplicates = 0
+        self.evicted = 0
+
+    def key(self, text: str) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.model_id.encode())
+        digest.update(b"\0")
+        digest.update(text.encode())
+        return digest.digest()
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Returns {key: vector} for the keys present in the cache and marks
+        them as recently used.
+        """
+        found = {}
+        for start in range(0, len(keys), QUERY_CHUNK):
+            chunk = keys[start:start + QUERY_CHUNK]
+            placeholders = ",".join("?" * len(chunk))
+            for key, vector in self.db.execute(
+                f"SELECT key, vector FROM cache WHERE key IN ({placeholders})", chunk
+            ):
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+            if found:
+                self.db.execute(
+                    f"UPDATE cache SET last_used = ? WHERE key IN ({placeholders})",
+                    [self._tick()] + chunk,
+                )
+        self.db.commit()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, keys: list, vectors: np.ndarray):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        clock = self._tick()
+        rows = [(key, vector.tobytes(), clock) for key, vector in zip(keys, vectors)]
+        # Replacing an existing key would double count it; only insert new ones
+        before = self.db.total_changes
+        self.db.executemany("INSERT OR IGNORE INTO cache VALUES (?, ?, ?)", rows)
+        inserted = self.db.total_changes - before
+        self.db.commit()
+
+        if rows:
+            self.entries += inserted
+            self.total_bytes += inserted * len(rows[0][1])
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        Drops the least recently used entries until the cache fits into
+        `max_bytes` again.
+        """
+        while self.total_bytes > self.max_bytes and self.entries > 0:
+            count = max(1, int(self.entries * EVICT_FRACTION))
+            freed, dropped = self.db.execute(
+                "SELECT COALESCE(SUM(LENGTH(vector)), 0), COUNT(*) FROM "
+                "(SELECT vector FROM cache ORDER BY last_used LIMIT ?)", (count,)
+            ).fetchone()
+            self.db.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY last_used LIMIT ?)", (count,)
+            )
+            self.db.commit()
+            self.total_bytes -= freed
+            self.entries -= dropped
+            self.evicted += dropped
+
+    def group_duplicates(self, texts: list):
+        """
+        Returns (keys, rows_by_key, text_by_key): the cache key of every text,
+        and for each distinct key the positions of the texts that share it.
+        """
+        keys = [self.key(text) for text in texts]
+        rows_by_key = {}
+        text_by_key = {}
+        for position, (key, text) in enumerate(zip(keys, texts)):
+            if key in rows_by_key:
+                rows_by_key[key].append(position)
+            else:
+                rows_by_key[key] = [position]
+                text_by_key[key] = text
+        self.duplicates += len(texts) - len(rows_by_key)
+        return keys, rows_by_key, text_by_key
+
+    def get_or_compute(self, texts: list, compute) -> np.ndarray:
+        """
+        Returns one embedding per text. Only distinct texts missing from the
+        cache are passed to `compute(list of texts) -> (n, dim) array`.
+        """
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        _, rows_by_key, text_by_key = self.group_duplicates(texts)
+        found = self.get_many(list(rows_by_key))
+
+        missing = [key for key in rows_by_key if key not in found]
+        if missing:
+            computed = np.asarray(compute([text_by_key[key] for key in missing]), dtype=np.float32)
+            self.put_many(missing, computed)
+            found.update(zip(missing, computed))
+
+        dim = len(next(iter(found.values())))
+        result = np.empty((len(texts), dim), dtype=np.float32)
+        for key, rows in rows_by_key.items():
+            result[rows] = found[key]
+        return result
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "duplicates": self.duplicates,
+            "entries": self.entries,
+            "size_mb": round(self.total_bytes / 10**6, 1),
+            "evicted": self.evicted,
+        }
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,160 @@
+"""
+embedding_store.py
+
+Append-only binary store for post embeddings.
+
+A store is a directory holding
+  - `embeddings.bin`: one contiguous row-major float32 (or float16) matrix,
+  - `metadata/part-<first row>.parquet`: post metadata, one row per
+    embedding, with a `row_id` column giving the matrix row,
+  - `store.json`: dimension, dtype and the number of committed rows.
+
+The matrix can be memory-mapped straight into a NumPy array, so readers such
+as cluster_video.py never parse or copy per-row objects. `store.json` is
+replaced atomically after the matrix and metadata of an append are on disk,
+so a crash mid-append leaves at most some uncommitted bytes that are dropped
+the next time the store is opened for writing.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+MATRIX_FILE = "embeddings.bin"
+METADATA_DIR = "metadata"
+HEADER_FILE = "store.json"
+DTYPES = {"float32": np.float32, "float16": np.float16}
+
+
+class EmbeddingStore:
+    def __init__(self, path: str, dim: int = None, dtype: str = "float32", create: bool = True):
+        """
+        Opens the store at `path`, creating it when it does not exist yet. For
+        a new store the dimension is taken from `dim` or from the first append.
+        Readers pass `create=False` to get a FileNotFoundError for a missing
+        store instead of an empty one.
+        """
+        self.path = path
+        self.matrix_path = os.path.join(path, MATRIX_FILE)
+        self.metadata_dir = os.path.join(path, METADATA_DIR)
+        self.header_path = os.path.join(path, HEADER_FILE)
+        self._recovered = False
+
+        if os.path.exists(self.header_path):
+            with open(self.header_path) as f:
+                header = json.load(f)
+            self.dim = header["dim"]
+            self.dtype = header["dtype"]
+            self.rows = header["rows"]
+        elif not create:
+            raise FileNotFoundError(f"No embedding store at {path}")
+        else:
+            if dtype not in DTYPES:
+                raise ValueError(f"Unsupported dtype {dtype!r}, expected one of {list(DTYPES)}")
+            os.makedirs(self.metadata_dir, exist_ok=True)
+            self.dim = dim
+            self.dtype = dtype
+            self.rows = 0
+            self._write_header()
+
+    def __len__(self) -> int:
+        return self.rows
+
+    @property
+    def np_dtype(self):
+        return DTYPES[self.dtype]
+
+    def _write_header(self):
+        tmp_path = self.header_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"dim": self.dim, "dtype": self.dtype, "rows": self.rows}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.header_path)
+
+    def _discard_uncommitted(self):
+        """
+        Drops matrix bytes and metadata parts past the committed row count,
+        left behind by an append that crashed before updating the header.
+        """
+        if self.dim is not None and os.path.exists(self.matrix_path):
+            committed_bytes = self.rows * self.dim * np.dtype(self.np_dtype).itemsize
+            if os.path.getsize(self.matrix_path) > committed_bytes:
+                os.truncate(self.matrix_path, committed_bytes)
+        for name in os.listdir(self.metadata_dir):
+            first_row = int(name.split("-")[1].split(".")[0])
+            if first_row >= self.rows:
+                os.remove(os.path.join(self.metadata_dir, name))
+
+    def append(self, embeddings: np.ndarray, metadata) -> range:
+        """
+        Appends `embeddings` (n x dim) with one metadata row each, given as a
+        DataFrame or an Arrow table, and returns the row ids they were stored
+        under.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.np_dtype)
+        if embeddings.ndim != 2 or len(embeddings) != len(metadata):
+            raise ValueError("Expected an (n, dim) matrix with one metadata row per embedding")
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"Store holds {self.dim}-dim embeddings, got {embeddings.shape[1]}")
+        if not self._recovered:
+            self._discard_uncommitted()
+            self._recovered = True
+
+        first_row = self.rows
+        row_ids = range(first_row, first_row + len(embeddings))
+
+        with open(self.matrix_path, "ab") as f:
+            embeddings.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if isinstance(metadata, pa.Table):
+            table = metadata
+        else:
+            table = pa.Table.from_pandas(metadata.reset_index(drop=True), preserve_index=False)
+        table = table.append_column("row_id", pa.array(row_ids, type=pa.int64()))
+        pq.write_table(table, os.path.join(self.metadata_dir, f"part-{first_row:012d}.parquet"))
+
+        self.rows += len(embeddings)
+        self._write_header()
+        return row_ids
+
+    def matrix(self) -> np.ndarray:
+        """
+        Returns the committed embeddings as a read-only (rows x dim) memory map.
+        """
+        if self.rows == 0:
+            return np.empty((0, self.dim or 0), dtype=self.np_dtype)
+        return np.memmap(self.matrix_path, dtype=self.np_dtype, mode="r",
+                         shape=(self.rows, self.dim))
+
+    def metadata(self, columns: list = None, start_row: int = 0) -> pd.DataFrame:
+        """
+        Returns the metadata of the committed rows from `start_row` on,
+        ordered by `row_id`. Only the parts holding those rows are read.
+        """
+        if columns is not None and "row_id" not in columns:
+            columns = list(columns) + ["row_id"]
+        first_rows = sorted(
+            int(name.split("-")[1].split(".")[0]) for name in os.listdir(self.metadata_dir)
+        )
+        first_rows = [row for row in first_rows if row < self.rows]
+        # A part is needed if the next part starts after start_row
+        parts = [
+            os.path.join(self.metadata_dir, f"part-{first_row:012d}.parquet")
+            for first_row, next_first in zip(first_rows, first_rows[1:] + [self.rows])
+            if next_first > start_row
+        ]
+        if not parts:
+            return pd.DataFrame(columns=columns or ["row_id"])
+        df = pd.concat([pd.read_parquet(part, columns=columns) for part in parts],
+                       ignore_index=True)
+        df = df[(df["row_id"] >= start_row) & (df["row_id"] < self.rows)]
+        return df.sort_values("row_id").reset_index(drop=True)
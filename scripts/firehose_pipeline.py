@@ -0,0 +1,392 @@
+"""
+firehose_pipeline.py
+
+Decoding and the optional multi-process ingestion pipeline for the firehose
+scraper.
+
+In pipeline mode the websocket callback only enqueues the raw message frame
+into a bounded queue. A pool of worker processes does the CAR / DAG-CBOR
+decoding and the language filtering, and a single writer thread in the main
+process hands the decoded posts to the persistence callback. Queue depth,
+dropped frames and frames that had to wait for a free slot are reported
+periodically, together with how far behind the firehose the decoders are.
+The same figures, plus the decode latency per frame, are recorded in the
+metrics registry (see metrics.py).
+"""
+
+import multiprocessing as mp
+import queue
+import signal
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+
+from atproto_client.models import get_or_create
+from atproto import CAR, models
+from atproto_firehose import parse_subscribe_repos_message
+from atproto_firehose.models import MessageFrame, MessageFrameHeader
+
+import metrics
+
+# Seconds between two backpressure reports
+STATS_INTERVAL = 30
+# Decoded frames held back while waiting for an earlier one; beyond this the
+# earlier frame is given up as lost (e.g. with a crashed worker)
+MAX_REORDER_FRAMES = 10_000
+# Seconds stop() waits for a worker to exit before terminating it
+WORKER_JOIN_TIMEOUT = 10.0
+
+FRAMES_RECEIVED = metrics.counter("firehose_frames_received_total", "Frames received from the websocket")
+FRAMES_DROPPED = metrics.counter("firehose_frames_dropped_total", "Frames dropped because the decode queue was full")
+FRAMES_DECODED = metrics.counter("firehose_frames_decoded_total", "Frames decoded")
+FRAMES_LOST = metrics.counter("firehose_frames_lost_total", "Enqueued frames whose decode result never arrived")
+FRAMES_FILTERED = metrics.counter("firehose_frames_filtered_total", "Decoded frames without an English post")
+POSTS_DECODED = metrics.counter("firehose_posts_decoded_total", "English posts decoded")
+DECODE_SECONDS = metrics.histogram("firehose_decode_seconds", "Time to decode one frame")
+QUEUE_DEPTH = metrics.gauge("firehose_queue_depth", "Frames waiting for a decode worker")
+COMMIT_LAG = metrics.gauge("firehose_commit_lag_seconds", "Age of the last decoded commit")
+
+
+def extract_posts(message) -> list:
+    """
+    Decodes a firehose message frame and returns the English, non-empty feed
+    posts it creates as dicts with `text`, `createdAt`, `uri` and `lang` (the
+    first declared language).
+    """
+    commit = parse_subscribe_repos_message(message)
+    if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
+        return []
+
+    car = CAR.from_bytes(commit.blocks)
+
+    posts = []
+    for op in commit.ops:
+        if op.action == "create" and op.cid:
+            raw = car.blocks.get(op.cid)
+            cooked = get_or_create(raw, strict=False)
+
+            # Only process feed posts
+            if cooked is not None and cooked.py_type == "app.bsky.feed.post":
+                text = raw.get("text")
+                langs = raw.get("langs")
+                created_at = raw.get("createdAt")
+
+                text_is_non_empty = bool(text and text.strip())
+                langs_is_english = (
+                    langs
+                    and isinstance(langs, list)
+                    and "en" in langs
+                )
+
+                if text_is_non_empty and langs_is_english and created_at:
+                    posts.append({
+                        "text": text,
+                        "createdAt": created_at,
+                        "uri": f"at://{commit.repo}/{op.path}",
+                        "lang": langs[0],
+                    })
+    return posts
+
+
+def record_decoded(posts: list, seconds: float):
+    """
+    Records one decoded frame and its decode time in the metrics registry.
+    """
+    FRAMES_DECODED.inc()
+    DECODE_SECONDS.observe(seconds)
+    POSTS_DECODED.inc(len(posts))
+    if not posts:
+        FRAMES_FILTERED.inc()
+
+
+def frame_seq(body: dict):
+    """
+    Returns the firehose sequence number of a frame body, or None for
+    frames without one (e.g. #info).
+    """
+    seq = body.get("seq") if isinstance(body, dict) else None
+    return seq if isinstance(seq, int) else None
+
+
+def commit_lag_seconds(body: dict) -> float:
+    """
+    Returns how many seconds ago the relay emitted the commit in `body`,
+    or 0.0 if the frame carries no usable timestamp.
+    """
+    emitted = body.get("time") if isinstance(body, dict) else None
+    if not isinstance(emitted, str):
+        return 0.0
+    try:
+        emitted_at = datetime.fromisoformat(emitted)
+    except ValueError:
+        return 0.0
+    if emitted_at.tzinfo is None:
+        emitted_at = emitted_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (datetime.now(timezone.utc) - emitted_at).total_seconds())
+
+
+def _decode_worker(frame_queue, result_queue):
+    """
+    Worker process: turns (index, type, body) frames into
+    (index, seq, posts, lag, decode seconds) results until it receives the
+    `None` sentinel.
+    """
+    # Ctrl-C reaches the whole process group; the main process shuts the
+    # workers down through the sentinel, after the writer has drained them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        item = frame_queue.get()
+        if item is None:
+            result_queue.put(None)
+            return
+
+        index, frame_type, body = item
+        message = MessageFrame(MessageFrameHeader(t=frame_type), body)
+        start = time.perf_counter()
+        try:
+            posts = extract_posts(message)
+        except Exception as e:  # a single broken frame must not kill the worker
+            print(f"Failed to decode frame: {e!r}")
+            posts = []
+        result_queue.put((index, frame_seq(body), posts, commit_lag_seconds(body), time.perf_counter() - start))
+
+
+class PipelineStats:
+    """
+    The figures the metrics registry does not keep. Each field has a single
+    writer (frames_blocked the receive thread, the others the writer
+    thread), so none of them needs a lock.
+    """
+
+    def __init__(self):
+        self.frames_blocked = 0
+        self.max_lag = 0.0
+        self.reorder_buffered = 0
+
+    def snapshot(self) -> dict:
+        """
+        Returns these figures together with the pipeline's counters from
+        the metrics registry (process-wide, so earlier pipelines of the same
+        process count too).
+        """
+        return {
+            "frames_received": FRAMES_RECEIVED.value,
+            "frames_dropped": FRAMES_DROPPED.value,
+            "frames_blocked": self.frames_blocked,
+            "frames_decoded": FRAMES_DECODED.value,
+            "frames_lost": FRAMES_LOST.value,
+            "posts_decoded": POSTS_DECODED.value,
+            "last_lag_s": round(COMMIT_LAG.value, 3),
+            "max_lag_s": round(self.max_lag, 3),
+            "reorder_buffered": self.reorder_buffered,
+        }
+
+
+class FirehosePipeline:
+    """
+    Bounded receive -> decode pool -> single writer pipeline.
+
+    `on_posts(posts, seq)` is called from the writer thread only, once per
+    frame and in the order the frames were received, so the writer can treat
+    `seq` as a resume cursor. With `drop_when_full` the receive callback drops
+    frames when the queue is full instead of blocking the websocket.
+
+    A worker that dies without its sentinel does not stall the writer: once
+    no worker is alive, the writer drains what is left and finishes. A frame
+    whose result never arrives is skipped once `max_reorder` later frames
+    are waiting for it.
+
+    If `on_posts` raises, the writer keeps the exception in `error`, discards
+    the remaining results so the workers can still exit, and calls
+    `on_error(error)` unless stop() is already running; `on_message` raises
+    from then on.
+    """
+
+    def __init__(self, on_posts, num_workers: int, queue_size: int = 10_000,
+                 drop_when_full: bool = False, stats_interval: float = STATS_INTERVAL,
+                 max_reorder: int = MAX_REORDER_FRAMES, on_error=None):
+        self.on_posts = on_posts
+        self.on_error = on_error
+        self.num_workers = num_workers
+        self.max_reorder = max_reorder
+        self.drop_when_full = drop_when_full
+        self.stats_interval = stats_interval
+        self.stats = PipelineStats()
+
+        self.frame_queue = mp.Queue(maxsize=queue_size)
+        self.result_queue = mp.Queue()
+        self.workers = []
+        self.writer_thread = None
+        self.error = None
+        self._stopping = False
+        self._finished_workers = 0
+        self._last_report = time.monotonic()
+        self._next_index = 0
+
+    def queue_depth(self) -> int:
+        try:
+            return self.frame_queue.qsize()
+        except NotImplementedError:  # macOS has no sem_getvalue
+            return -1
+
+    def start(self):
+        for _ in range(self.num_workers):
+            worker = mp.Process(target=_decode_worker,
+                                args=(self.frame_queue, self.result_queue),
+                                daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        self.writer_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer_thread.start()
+
+    def on_message(self, message):
+        """
+        Firehose client callback: enqueue the raw frame and return immediately.
+        """
+        if self.error is not None:
+            raise RuntimeError("Pipeline writer failed, not accepting frames") from self.error
+        FRAMES_RECEIVED.inc()
+        # Frames are only numbered once enqueued, so dropped frames never
+        # leave a gap the writer would wait for
+        item = (self._next_index, message.type, message.body)
+        try:
+            self.frame_queue.put_nowait(item)
+        except queue.Full:
+            if self.drop_when_full:
+                FRAMES_DROPPED.inc()
+                return
+            self.stats.frames_blocked += 1
+            self.frame_queue.put(item)
+        self._next_index += 1
+
+    def _write_loop(self):
+        try:
+            self._write_results()
+        except Exception as e:  # e.g. a full disk in on_posts
+            self.error = e
+            traceback.print_exc()
+            print("Pipeline writer failed; discarding further results")
+            if self.on_error is not None and not self._stopping:
+                self.on_error(e)
+            self._discard_results()
+
+    def _write_results(self):
+        # Workers finish out of order; hold results until their turn comes
+        reorder_buffer = {}
+        next_index = 0
+        while self._finished_workers < len(self.workers):
+            try:
+                result = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                self._maybe_report()
+                if not any(worker.is_alive() for worker in self.workers):
+                    # Workers that crashed or were killed never send their sentinel
+                    break
+                continue
+
+            if result is None:
+                self._finished_workers += 1
+                continue
+
+            self._record(result, reorder_buffer)
+            next_index = self._release(reorder_buffer, next_index)
+            if len(reorder_buffer) > self.max_reorder:
+                next_index = self._skip_lost(reorder_buffer, next_index)
+            self._maybe_report()
+
+        # Results a dead worker flushed on its way out, then whatever is
+        # still waiting for a frame that will never arrive
+        while True:
+            try:
+                result = self.result_queue.get_nowait()
+            except queue.Empty:
+                break
+            if result is not None:
+                self._record(result, reorder_buffer)
+        while reorder_buffer:
+            next_index = self._release(reorder_buffer, self._skip_lost(reorder_buffer, next_index))
+        lost = self._next_index - next_index
+        if lost > 0:
+            self._count_lost(lost)
+
+    def _discard_results(self):
+        """
+        Keeps reading results after a failure: a worker only exits once its
+        results are out of the pipe.
+        """
+        while self._finished_workers < len(self.workers):
+            try:
+                result = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in self.workers):
+                    break
+                continue
+            if result is None:
+                self._finished_workers += 1
+
+    def _record(self, result, reorder_buffer: dict):
+        index, seq, posts, lag, seconds = result
+        record_decoded(posts, seconds)
+        COMMIT_LAG.set(lag)
+        QUEUE_DEPTH.set(self.queue_depth())
+        reorder_buffer[index] = (seq, posts)
+        self.stats.max_lag = max(self.stats.max_lag, lag)
+        self.stats.reorder_buffered = len(reorder_buffer)
+
+    def _release(self, reorder_buffer: dict, next_index: int) -> int:
+        while next_index in reorder_buffer:
+            seq, posts = reorder_buffer.pop(next_index)
+            self.on_posts(posts, seq)
+            next_index += 1
+        self.stats.reorder_buffered = len(reorder_buffer)
+        return next_index
+
+    def _skip_lost(self, reorder_buffer: dict, next_index: int) -> int:
+        """
+        Gives up on the frames before the oldest buffered result.
+        """
+        resume_index = min(reorder_buffer)
+        self._count_lost(resume_index - next_index)
+        return resume_index
+
+    def _count_lost(self, frames: int):
+        if frames <= 0:
+            return
+        print(f"Lost {frames} frame(s) whose decode result never arrived")
+        FRAMES_LOST.inc(frames)
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        if now - self._last_report < self.stats_interval:
+            return
+        self._last_report = now
+        print(f"Pipeline stats: queue_depth={self.queue_depth()} {self.stats.snapshot()}")
+
+    def stop(self):
+        """
+        Drains the queue, stops the workers and waits for the writer to
+        persist everything that was decoded.
+        """
+        self._stopping = True
+        for _ in self.workers:
+            while True:
+                try:
+                    self.frame_queue.put(None, timeout=1.0)
+                    break
+                except queue.Full:
+                    # Nobody left to make room
+                    if not any(worker.is_alive() for worker in self.workers):
+                        break
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+        for worker in self.workers:
+            worker.join(WORKER_JOIN_TIMEOUT)
+            if worker.is_alive():
+                print(f"Decode worker {worker.pid} did not exit, terminating it")
+                worker.terminate()
+                worker.join()
+                # Sentinels it never read must not block the interpreter exit
+                self.frame_queue.cancel_join_thread()
+        print(f"Pipeline stats: {self.stats.snapshot()}")
@@ -1,164 +1,273 @@
 import os
-from sys import getsizeof
+import argparse
 import json
+import signal
+import time
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 
-import pandas as pd
 import pyarrow as pa
-import pyarrow.parquet as pq
 
-from atproto_client.models import get_or_create
-from atproto import CAR, models
-from atproto_firehose import FirehoseSubscribeReposClient, parse_subscribe_repos_message
+from atproto_firehose import FirehoseSubscribeReposClient
 
-client = FirehoseSubscribeReposClient()
+import metrics
+from firehose_pipeline import FRAMES_RECEIVED, FirehosePipeline, extract_posts, frame_seq, record_decoded
+from post_buffer import DayBuffers
+from rollups import RollupStore
+from segment_writer import DaySegmentWriter
+
+client = None
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 data_dir = os.path.join(script_dir, '..', 'data')
 os.makedirs(data_dir, exist_ok=True)
 
-# credit: stackoverflow
-def get_size(obj, seen=None):
-    """Recursively finds size of objects"""
-    size = getsizeof(obj)
-    if seen is None:
-        seen = set()
-    obj_id = id(obj)
-    if obj_id in seen:
-        return 0
-    # Important mark as seen *before* entering recursion to gracefully handle
-    # self-referential objects
-    seen.add(obj_id)
-    if isinstance(obj, dict):
-        size += sum([get_size(v, seen) for v in obj.values()])
-        size += sum([get_size(k, seen) for k in obj.keys()])
-    elif hasattr(obj, '__dict__'):
-        size += get_size(obj.__dict__, seen)
-    elif hasattr(obj, '__iter__') and not isinstance(obj, (str, bytes, bytearray)):
-        size += sum([get_size(i, seen) for i in obj])
-    return size
-
 MB = 10**6
 GB = 10**3 * MB
 FLUST_THRESHOLD = 1000
 SIZE_STATS_INTERVAL = FLUST_THRESHOLD * 100
 MAX_CACHE_SIZE = 32 * GB
 
-post_dictionary = dict()
-posts_for_current_day = []
-date_usage = []
+# Byte-accounted buffers of not yet persisted posts, keyed by day
+post_buffers = DayBuffers(MAX_CACHE_SIZE)
 
 total_posts_written = 0
 
+POST_SCHEMA = pa.schema([
+    ("text", pa.string()),
+    ("createdAt", pa.string()),
+    ("uri", pa.string()),
+    ("lang", pa.string()),
+])
+
+# Per-minute post counts, kept current as segments are written (see stats.py)
+rollups = RollupStore(data_dir)
+segment_writer = DaySegmentWriter(data_dir, POST_SCHEMA,
+                                  on_segment=rollups.add_segment,
+                                  on_finalize=rollups.rebuild_day)
+
+CHECKPOINT_PATH = os.path.join(data_dir, "firehose_checkpoint.json")
+
+FLUSH_SECONDS = metrics.histogram("scraper_flush_seconds", "Time to write one segment, rollup update included")
+FINALIZE_SECONDS = metrics.histogram("scraper_finalize_seconds", "Time to compact a day's segments")
+POSTS_WRITTEN = metrics.counter("scraper_posts_written_total", "Posts written to segments")
+BUFFER_BYTES = metrics.gauge("scraper_buffer_bytes", "Estimated bytes of buffered, unwritten posts")
+BUFFER_POSTS = metrics.gauge("scraper_buffer_posts", "Buffered, unwritten posts")
+
+# seq of the last frame whose posts are all buffered or persisted
+last_complete_seq = None
+# uris of the frame after last_complete_seq that already made it into the buffer
+partial_frame_uris = []
+# uris the previous run persisted past its checkpoint; skipped when replayed
+replayed_uris = set()
+
 def get_current_day():
     return datetime.now().strftime("%Y-%m-%d")
 
+current_day = get_current_day()
+
+def save_checkpoint(seq: int, uris: list):
+    tmp_path = CHECKPOINT_PATH + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"seq": seq, "uris": uris}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, CHECKPOINT_PATH)
+
+def load_checkpoint():
+    """
+    Returns (seq, uris) of the newest checkpoint. A segment carries its own
+    checkpoint in its metadata, so a crash between writing a segment and
+    updating the checkpoint file loses nothing.
+    """
+    seq, uris = None, []
+    if os.path.exists(CHECKPOINT_PATH):
+        with open(CHECKPOINT_PATH) as f:
+            checkpoint = json.load(f)
+        seq, uris = checkpoint["seq"], checkpoint["uris"]
+
+    latest_segment = segment_writer.latest_segment()
+    if latest_segment is not None:
+        metadata = segment_writer.read_segment_metadata(latest_segment)
+        if "firehose_seq" in metadata:
+            segment_seq = int(metadata["firehose_seq"])
+            if seq is None or segment_seq > seq:
+                seq = segment_seq
+                uris = json.loads(metadata["firehose_partial_uris"])
+
+    return seq, uris
+
 def flush_posts_to_parquet(filename: str, posts: list) -> int:
-    if not posts:
-        return 0
+    # Only the new rows are written; earlier flushes of the day stay on disk
+    metadata = None
+    # The cursor is only a valid checkpoint once no other day holds unwritten posts
+    if last_complete_seq is not None and post_buffers.total_posts == 0:
+        metadata = {
+            "firehose_seq": last_complete_seq,
+            "firehose_partial_uris": json.dumps(partial_frame_uris),
+        }
+    with FLUSH_SECONDS.time():
+        written = segment_writer.write_segment(filename, posts, metadata)
+    POSTS_WRITTEN.inc(written)
+    return written
 
-    df = pd.DataFrame(posts)
-    table = pa.Table.from_pandas(df)
-    parquet_file_path = os.path.join(data_dir, f"{filename}.parquet")
-    pq.write_table(table, parquet_file_path)
+def flush_day(day: str):
+    global total_posts_written
 
-    return len(posts)
+    posts = post_buffers.pop(day)
+    BUFFER_BYTES.set(post_buffers.total_bytes)
+    BUFFER_POSTS.set(post_buffers.total_posts)
+    flushed = 0
+    if posts:
+        try:
+            flushed = flush_posts_to_parquet(day, posts)
+        except Exception:
+            # Keep them buffered, so the checkpoint below never passes them
+            for post in posts:
+                post_buffers.append(day, post)
+            raise
+        total_posts_written += flushed
+        print(f"Total posts written: {total_posts_written}")
+        print(f"Timestamp of last post written: {posts[-1]['createdAt']}")
 
-def on_message_handler(message):
-    global current_day, posts_for_current_day, total_posts_written
+    if last_complete_seq is not None and post_buffers.total_posts == 0:
+        save_checkpoint(last_complete_seq, partial_frame_uris)
+        # Reconnects resume from what is persisted, not from the first cursor
+        client.update_params({"cursor": last_complete_seq})
+
+    return flushed
 
+def evict_buffers():
+    """
+    Flushes the least recently used day buffers to disk until the buffered
+    bytes fit into MAX_CACHE_SIZE again.
+    """
+    while post_buffers.over_budget():
+        day = post_buffers.least_recent_day()
+        print(f"Buffers hold {post_buffers.total_bytes/MB:.1f} MB, evicting {day} "
+              f"({post_buffers.day_bytes(day)/MB:.1f} MB)")
+        flush_day(day)
+
+def roll_over_day():
+    global current_day
+
+    flush_day(current_day)
+    with FINALIZE_SECONDS.time():
+        rows = segment_writer.finalize_day(current_day)
+    print(f"Finalized {current_day}.parquet with {rows} posts")
     current_day = get_current_day()
 
-    commit = parse_subscribe_repos_message(message)
-    if not isinstance(commit, models.ComAtprotoSyncSubscribeRepos.Commit):
+def handle_posts(posts: list, seq: int = None):
+    """
+    Buffers the posts decoded from the frame with sequence number `seq` for
+    the current day, flushing a segment every FLUST_THRESHOLD posts and
+    compacting the day file on rollover. Frames have to arrive in seq order.
+    """
+    global last_complete_seq
+
+    if seq is not None and last_complete_seq is not None and seq <= last_complete_seq:
+        # Replayed after a reconnect or restart; already buffered or persisted
         return
 
-    car = CAR.from_bytes(commit.blocks)
-
-    for op in commit.ops:
-        if op.action == "create" and op.cid:
-            raw = car.blocks.get(op.cid)
-            cooked = get_or_create(raw, strict=False)
-
-            # Only process feed posts
-            if cooked is not None and cooked.py_type == "app.bsky.feed.post":
-                text = raw.get("text")
-                langs = raw.get("langs")
-                created_at = raw.get("createdAt")
-
-                text_is_non_empty = bool(text and text.strip())
-                langs_is_english = (
-                    langs
-                    and isinstance(langs, list)
-                    and "en" in langs
-                )
-
-                if text_is_non_empty and langs_is_english and created_at: 
-                    if current_day != get_current_day() or len(posts_for_current_day) >= FLUST_THRESHOLD:
-                        if current_day in post_dictionary:
-                            flushed_posts = post_dictionary[current_day]
-                        else:
-                            flushed_posts = []
-
-                        flushed_posts += posts_for_current_day
-                        flushed = flush_posts_to_parquet(current_day, flushed_posts)
-                        total_posts_written += len(posts_for_current_day)
-                        post_dictionary[current_day] = flushed_posts                  
-                        if current_day in date_usage:
-                            date_usage.remove(current_day)
-                        date_usage.append(current_day)
-                        print(f"Total posts written: {total_posts_written}")
-                        print(f"Timestamp of last post written: {posts_for_current_day[-1]['createdAt']}")
-                        posts_for_current_day.clear()
-                        current_day = get_current_day()               
-
-                        # memory snap flag
-                        if total_posts_written % SIZE_STATS_INTERVAL == 0:
-                            print(f"Memory usage stats:")
-                            print(f"Total posts written: {total_posts_written}")
-                            print(f"Timestamp of last post written: {created_at}")
-                            print(f"Current dictionary size is {get_size(post_dictionary)/MB} MB")
-                    
-                    # if getsizeof(posts_for_current_day) >= MAX_CACHE_SIZE:
-                    #     print(f"Dictionary is too large: {getsizeof(posts_for_current_day)}")
-                    #     if current_day != date_usage[0]:
-                    #         post_dictionary.pop(date_usage[0])
-                    #         date_usage.pop(0)
-                    #     print(f"New dictionary size is {getsizeof(posts_for_current_day)}")
-
-                    # Add post to current day's buffer
-                    posts_for_current_day.append({
-                        "text": text,
-                        "createdAt": created_at,
-                    })
-def main():
-    global current_day
+    for post in posts:
+        if post["uri"] in replayed_uris:
+            # Still part of this frame's persisted prefix if we flush mid-frame
+            partial_frame_uris.append(post["uri"])
+            continue
+
+        if current_day != get_current_day():
+            roll_over_day()
+        elif post_buffers.count(current_day) >= FLUST_THRESHOLD:
+            flush_day(current_day)
+
+            # memory snap flag
+            if total_posts_written % SIZE_STATS_INTERVAL == 0:
+                print(f"Memory usage stats:")
+                print(f"Total posts written: {total_posts_written}")
+                print(f"Timestamp of last post written: {post['createdAt']}")
+                print(f"Buffered: {post_buffers.total_posts} posts, {post_buffers.total_bytes/MB} MB")
+
+        # Add post to current day's buffer
+        post_buffers.append(current_day, post)
+        BUFFER_BYTES.set(post_buffers.total_bytes)
+        BUFFER_POSTS.set(post_buffers.total_posts)
+        partial_frame_uris.append(post["uri"])
+        evict_buffers()
+
+    if seq is not None:
+        last_complete_seq = seq
+        partial_frame_uris.clear()
+        replayed_uris.clear()
+
+def on_message_handler(message):
+    FRAMES_RECEIVED.inc()
+    start = time.perf_counter()
+    posts = extract_posts(message)
+    record_decoded(posts, time.perf_counter() - start)
+    handle_posts(posts, frame_seq(message.body))
+
+def on_pipeline_error(error):
+    # Shut down like on Ctrl-C, so the buffered posts are still flushed. The
+    # client swallows callback exceptions and only checks its stop flag when
+    # the next frame arrives
+    os.kill(os.getpid(), signal.SIGINT)
+
+def main(args):
+    global client, last_complete_seq
+
     print("Starting Bluesky Firehose scraper.")
+    stop_reporting = metrics.start_reporting(args)
+    client = FirehoseSubscribeReposClient(base_uri=args.base_uri)
+
+    last_complete_seq, uris = load_checkpoint()
+    if last_complete_seq is not None:
+        print(f"Resuming from firehose seq {last_complete_seq}")
+        replayed_uris.update(uris)
+        client.update_params({"cursor": last_complete_seq})
+
+    # Compact days left over from a previous run
+    for day in segment_writer.finalize_stale_days(current_day):
+        print(f"Finalized leftover segments of {day}")
+
+    pipeline = None
+    if args.workers > 0:
+        print(f"Decoding with {args.workers} worker processes (queue size {args.queue_size})")
+        pipeline = FirehosePipeline(handle_posts, args.workers,
+                                    queue_size=args.queue_size,
+                                    drop_when_full=args.drop_when_full,
+                                    on_error=on_pipeline_error)
+        pipeline.start()
+        callback = pipeline.on_message
+    else:
+        callback = on_message_handler
+
     try:
-        client.start(on_message_handler)
+        client.start(callback)
     except KeyboardInterrupt:
         print("Flushing remaining posts and exiting...")
     finally:
-        # Flush any remaining posts in the buffer
-        if posts_for_current_day and current_day:
-            if current_day in post_dictionary:
-                flushed_posts = post_dictionary[current_day]
-            else:
-                flushed_posts = []
-
-            flushed_posts += posts_for_current_day
-            flushed = flush_posts_to_parquet(current_day, flushed_posts)
-            total_posts_written += flushed
-            post_dictionary[current_day] = flushed_posts                  
-            if current_day in date_usage:
-                date_usage.remove(current_day)
-            date_usage.append(current_day)
-            print(f"Total posts written: {total_posts_written}")
-            print(f"Timestamp of last post written: {posts_for_current_day[-1]['createdAt']}")
-            posts_for_current_day.clear()
-            current_day = get_current_day()               
-                    
+        if pipeline is not None:
+            pipeline.stop()
+        # Flush any remaining posts in the buffers; the day is compacted on rollover
+        for day in post_buffers.days() or [current_day]:
+            flush_day(day)
+        stop_reporting()
+
+    if pipeline is not None and pipeline.error is not None:
+        raise SystemExit(f"Stopped after the pipeline writer failed: {pipeline.error!r}")
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    arg_parser = argparse.ArgumentParser(description="Capture English Bluesky posts from the firehose.")
+    arg_parser.add_argument("--workers", type=int, default=0,
+                            help="Decode frames in N worker processes (0 decodes inline in the websocket callback).")
+    arg_parser.add_argument("--queue_size", type=int, default=10_000,
+                            help="Maximum number of undecoded frames buffered in pipeline mode.")
+    arg_parser.add_argument("--drop_when_full", action="store_true",
+                            help="Drop frames instead of blocking the websocket when the queue is full.")
+    arg_parser.add_argument("--base_uri", type=str, default="wss://bsky.network/xrpc",
+                            help="Relay to subscribe to.")
+    metrics.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    main(args)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+forecast.py
+
+Forecasts cluster centroids as trajectories in embedding space.
+
+Reads the per-window centroids that cluster_video.py writes to
+../data/cluster_trajectories.embstore (cluster ids are stable across windows).
+The centroids are projected onto a shared PCA subspace (refitted on the past
+windows only at every backtest origin), and every model is fitted on all
+clusters at once with array operations, so re-forecasting hundreds of
+clusters takes well under a second on a CPU:
+  - LastValue: the centroid stays where it is (baseline),
+  - ConstantVelocityKalman: a Kalman filter on position and velocity. All
+    clusters and dimensions share the noise model, so the gain is computed
+    once per step and the filter is a few elementwise updates,
+  - VAR: a vector autoregression of order p on the subspace. Its coefficient
+    matrices are shared by all clusters and fitted by ridge least squares.
+
+Command-line arguments:
+  --trajectories (trajectory store written by cluster_video.py)
+  --components   (dimension of the PCA subspace the models work in)
+  --horizon      (number of windows to forecast)
+  --backtest     (score every model on a rolling-origin backtest first)
+  --backtest_stride (windows between two backtest origins)
+  --min_train    (windows of history before the first backtest origin)
+  --output       (npz file receiving the forecast in the full embedding space)
+"""
+
+import argparse as ap
+import time
+
+import numpy as np
+from sklearn.decomposition import PCA
+
+from embedding_store import EmbeddingStore
+
+
+def load_trajectories(path: str):
+    """
+    Returns (centroids, sizes) of shape (windows, clusters, dim) and
+    (windows, clusters) from a trajectory store.
+    """
+    store = EmbeddingStore(path, create=False)
+    metadata = store.metadata(columns=["window", "cluster", "size"])
+    windows = metadata["window"].max() + 1
+    clusters = metadata["cluster"].max() + 1
+    if windows * clusters != len(store):
+        raise ValueError(f"Expected {windows} x {clusters} centroids, found {len(store)}")
+
+    centroids = np.empty((windows, clusters, store.dim), dtype=np.float32)
+    sizes = np.zeros((windows, clusters), dtype=np.int64)
+    window, cluster = metadata["window"].to_numpy(), metadata["cluster"].to_numpy()
+    centroids[window, cluster] = store.matrix()[metadata["row_id"].to_numpy()]
+    sizes[window, cluster] = metadata["size"].to_numpy()
+    return centroids, sizes
+
+
+def fit_subspace(centroids: np.ndarray, n_components: int = 32, seed: int = 0):
+    """
+    Fits a PCA on all centroids of all given windows and returns (pca,
+    projected trajectories of shape (windows, clusters, n_components)).
+    """
+    windows, clusters, dim = centroids.shape
+    flat = centroids.reshape(-1, dim)
+    n_components = min(n_components, *flat.shape)
+    pca = PCA(n_components, svd_solver="randomized", random_state=seed).fit(flat)
+    return pca, pca.transform(flat).reshape(windows, clusters, n_components)
+
+
+def project(pca, centroids: np.ndarray) -> np.ndarray:
+    """
+    Projects (windows, clusters, dim) centroids onto a fitted subspace.
+    """
+    windows, clusters, dim = centroids.shape
+    return pca.transform(centroids.reshape(-1, dim)).reshape(windows, clusters, pca.n_components_)
+
+
+class LastValue:
+    def fit(self, history: np.ndarray):
+        self.last = history[-1]
+        return self
+
+    def predict(self, steps: int) -> np.ndarray:
+        return np.repeat(self.last[None], steps, axis=0)
+
+
+class ConstantVelocityKalman:
+    """
+    x_t = x_{t-1} + v_{t-1}, v_t = v_{t-1} + noise, observing x_t with noise.
+    """
+
+    def __init__(self, process_var: float = 1e-4, obs_var: float = 1e-3):
+        self.process_var = process_var
+        self.obs_var = obs_var
+
+    def fit(self, history: np.ndarray):
+        transition = np.array([[1.0, 1.0], [0.0, 1.0]])
+        process = self.process_var * np.array([[0.25, 0.5], [0.5, 1.0]])
+        position = history[0].astype(np.float64)
+        velocity = np.zeros_like(position)
+        covariance = np.diag([self.obs_var, 1.0])
+        for observation in history[1:]:
+            # predict
+            position = position + velocity
+            covariance = transition @ covariance @ transition.T + process
+            # update; the gain does not depend on the data, only on the step
+            gain = covariance[:, 0] / (covariance[0, 0] + self.obs_var)
+            innovation = observation - position
+            position = position + gain[0] * innovation
+            velocity = velocity + gain[1] * innovation
+            covariance = covariance - np.outer(gain, covariance[0])
+        self.position, self.velocity = position, velocity
+        return self
+
+    def predict(self, steps: int) -> np.ndarray:
+        ahead = np.arange(1, steps + 1)[:, None, None]
+        return self.position[None] + ahead * self.velocity[None]
+
+
+class VAR:
+    """
+    z_t = c + A_1 z_{t-1} + ... + A_p z_{t-p}, pooled over all clusters.
+    """
+
+    def __init__(self, order: int = 2, ridge: float = 1e-2):
+        self.order = order
+        self.ridge = ridge
+
+    def _lags(self, history: np.ndarray, t: int) -> np.ndarray:
+        # (clusters, order * dim + 1) design rows for predicting step t
+        lags = [history[t - lag] for lag in range(1, self.order + 1)]
+        return np.concatenate(lags + [np.ones((history.shape[1], 1))], axis=1)
+
+    def fit(self, history: np.ndarray):
+        windows, clusters, dim = history.shape
+        if windows <= self.order:
+            raise ValueError(f"VAR({self.order}) needs more than {self.order} windows of history")
+        design = np.concatenate([self._lags(history, t) for t in range(self.order, windows)])
+        targets = history[self.order:].reshape(-1, dim)
+        gram = design.T @ design + self.ridge * np.eye(design.shape[1])
+        self.coefficients = np.linalg.solve(gram, design.T @ targets)
+        self.history = history[-self.order:]
+        return self
+
+    def predict(self, steps: int) -> np.ndarray:
+        history = list(self.history)
+        predictions = []
+        for _ in range(steps):
+            step = self._lags(np.asarray(history), len(history)) @ self.coefficients
+            predictions.append(step)
+            history = history[1:] + [step]
+        return np.stack(predictions)
+
+
+MODELS = {
+    "last_value": LastValue,
+    "kalman": ConstantVelocityKalman,
+    "var": VAR,
+}
+
+
+def rolling_origin_backtest(centroids: np.ndarray, models: dict, horizon: int = 3, min_train: int = 10,
+                            n_components: int = 32, stride: int = 1):
+    """
+    At every `stride`-th origin t >= min_train, fits the PCA subspace on
+    windows [0, t) only, so no origin sees its future, and refits every model
+    of `models` (name -> class) on that shared projection. Each forecast is
+    scored against windows [t, t + horizon) projected onto the same subspace.
+
+    Returns ({name: (RMSE per step ahead (horizon,), RMSE per origin
+    (origins x horizon))}, averaged over clusters, and {name: ValueError} of
+    the models that could not be fitted (e.g. VAR on too short a history).
+    """
+    windows = centroids.shape[0]
+    origins = range(min_train, windows - horizon + 1, stride)
+    if not origins:
+        raise ValueError(f"Need more than {min_train + horizon - 1} windows for a backtest")
+
+    errors = {name: [] for name in models}
+    failures = {}
+    for origin in origins:
+        pca, history = fit_subspace(centroids[:origin], n_components)
+        actual = project(pca, centroids[origin:origin + horizon])
+        for name, make_model in models.items():
+            if name in failures:
+                continue
+            try:
+                predictions = make_model().fit(history).predict(horizon)
+            except ValueError as e:
+                failures[name] = e
+                continue
+            errors[name].append(np.sqrt(((predictions - actual) ** 2).sum(axis=2).mean(axis=1)))
+
+    results = {}
+    for name, model_errors in errors.items():
+        if name not in failures:
+            model_errors = np.stack(model_errors)
+            results[name] = np.sqrt((model_errors ** 2).mean(axis=0)), model_errors
+    return results, failures
+
+
+def main(args):
+    centroids, _ = load_trajectories(args.trajectories)
+    print(f"Loaded {centroids.shape[1]} cluster trajectories over {centroids.shape[0]} windows")
+    pca, trajectories = fit_subspace(centroids, args.components)
+    print(f"PCA subspace of {trajectories.shape[2]} dims keeps "
+          f"{pca.explained_variance_ratio_.sum():.1%} of the centroid variance")
+
+    if args.backtest:
+        start = time.perf_counter()
+        try:
+            results, failures = rolling_origin_backtest(centroids, MODELS, args.horizon, args.min_train,
+                                                        args.components, args.backtest_stride)
+        except ValueError as e:
+            results, failures = {}, {}
+            print(f"Backtest: {e}")
+        for name, (per_step, errors) in results.items():
+            steps = ", ".join(f"t+{k + 1}: {rmse:.4f}" for k, rmse in enumerate(per_step))
+            print(f"{name:>10}  RMSE {steps}  ({len(errors)} origins)")
+        for name, e in failures.items():
+            print(f"{name}: {e}")
+        print(f"Backtest took {time.perf_counter() - start:.2f}s")
+
+    forecasts = {
+        name: pca.inverse_transform(model().fit(trajectories).predict(args.horizon).reshape(
+            -1, trajectories.shape[2])).reshape(args.horizon, *centroids.shape[1:]).astype(np.float32)
+        for name, model in MODELS.items()
+        if not (name == "var" and len(trajectories) <= VAR().order)
+    }
+    np.savez(args.output, **forecasts)
+    print(f"Wrote {args.horizon}-step forecasts of {', '.join(forecasts)} to {args.output}")
+
+
+if __name__ == "__main__":
+    arg_parser = ap.ArgumentParser(description="Forecast cluster centroid trajectories.")
+    arg_parser.add_argument("--trajectories", type=str, default="../data/cluster_trajectories.embstore",
+                            help="Trajectory store written by cluster_video.py.")
+    arg_parser.add_argument("--components", type=int, default=32,
+                            help="Dimension of the PCA subspace the models work in.")
+    arg_parser.add_argument("--horizon", type=int, default=3,
+                            help="Number of windows to forecast.")
+    arg_parser.add_argument("--backtest", action="store_true",
+                            help="Score every model on a rolling-origin backtest before forecasting.")
+    arg_parser.add_argument("--backtest_stride", type=int, default=1,
+                            help="Windows between two backtest origins; the PCA is refitted at each origin.")
+    arg_parser.add_argument("--min_train", type=int, default=10,
+                            help="Windows of history before the first backtest origin.")
+    arg_parser.add_argument("--output", type=str, default="../data/cluster_forecast.npz",
+                            help="Forecasts per model, (horizon, clusters, dim) in embedding space.")
+    args = arg_parser.parse_args()
+
+    main(args)
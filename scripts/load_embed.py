@@ -4,15 +4,32 @@ load_embed.py
 
 Hardcoded script to:
   - Load the 'alpindale/two-million-bluesky-posts' dataset from HF
-  - Filter posts between a given time range
-  - Discard any post whose `text` is empty
-  - Embed the remaining posts using an EXISTING Hugging Face Inference Endpoint
-  - Save partial results (CSV) into ../data/, with the time range in its filename
+  - Filter posts between a given time range and discard any post whose
+    `text` is empty, using a cached timestamp index (see time_index.py)
+  - Embed the remaining posts using an EXISTING Hugging Face Inference Endpoint,
+    with many token-budgeted batches in flight at once (see embed_client.py),
+    or with --backend local on this machine's CPUs (see local_embedder.py)
+  - Save partial results into an embedding store (see embedding_store.py) in
+    ../data/, with the time range in its name
 
 Command-line arguments:
   --start_time (ISO 8601, e.g. "2024-11-27T07:00:00")
   --end_time   (ISO 8601, e.g. "2024-11-27T08:00:00")
   --checkpoint_interval (save partial results every N batches)
+  --concurrency        (number of requests in flight)
+  --max_batch_tokens   (estimated token budget per request)
+  --max_batch_size     (maximum number of texts per request)
+  --dtype              (float32 or float16 storage for the embedding matrix)
+  --model_id           (model behind the endpoint, keys the embedding cache)
+  --backend            (endpoint, or local for CPU inference)
+  --local_model / --runtime / --pooling / --max_length / --workers / --threads_per_worker
+                       (model and inference settings of the local backend)
+  --cache_max_gb       (size cap of the embedding cache in ../data/)
+  --dedup              (embed one representative per group of near-duplicate
+                        posts, with a `multiplicity` column; see dedup_filter.py)
+  --metrics_port / --metrics_log / --metrics_interval / --profile
+                       (request latency, batch fill and write time as
+                        Prometheus metrics or JSON lines; see metrics.py)
 
 IMPORTANT: 
   1. You need to be logged into Hugging Face with credentials that have access 
@@ -24,17 +41,16 @@ IMPORTANT:
 
 import os
 import sys
-import json
 import argparse as ap  # <-- Aliasing argparse to avoid conflict with dateutil.parser
 import numpy as np
-import pandas as pd
+import pyarrow as pa
 from tqdm import tqdm
 from dateutil import parser
 from datetime import datetime, timezone
 
 # Hugging Face
 try:
-    from huggingface_hub import InferenceClient
+    from huggingface_hub import get_token
 except ImportError:
     print("Please install `huggingface_hub` via `pip install huggingface_hub`.")
     sys.exit(1)
@@ -46,6 +62,15 @@ except ImportError:
     print("Please install `datasets` via `pip install datasets`.")
     sys.exit(1)
 
+import metrics
+from dedup_filter import collapse_near_duplicates
+from embed_client import EmbeddingClient
+from local_embedder import POOLING, RUNTIMES, LocalEmbedder
+from embedding_cache import EmbeddingCache, GB
+from embedding_store import EmbeddingStore
+from progress_journal import ProgressJournal
+from time_index import TimeIndex
+
 
 ###############################################################################
 # Hardcoded constants (matching original notebook)
@@ -55,8 +80,24 @@ DATASET_PATH = "alpindale/two-million-bluesky-posts"
 # EXISTING endpoint URL
 ENDPOINT_URL = "https://oip5t8y3edcaq2fe.us-east-1.aws.endpoints.huggingface.cloud"
 
-# We'll embed in small batches (like the original code)
-BATCH_SIZE = 2
+# Defaults sized for TEI with MAX_BATCH_TOKENS=10240, MAX_CONCURRENT_REQUESTS=512
+CONCURRENCY = 32
+MAX_BATCH_TOKENS = 8192
+MAX_BATCH_SIZE = 256
+
+# Model behind the endpoint; part of the embedding cache key
+MODEL_ID = "nvidia/NV-Embed-v2"
+# Model of the local backend, as in embed.ipynb
+LOCAL_MODEL_ID = "Alibaba-NLP/gte-Qwen2-1.5B-instruct"
+# embed.ipynb's SentenceTransformer runs in full precision with the model's
+# last-token pooling; only local runs with the same settings share its cache key
+NOTEBOOK_RUNTIME = "onnx"
+NOTEBOOK_POOLING = "last"
+CACHE_FILENAME = "embedding_cache.sqlite"
+# Rows per store append when replaying cache hits
+CACHED_WRITE_CHUNK = 10_000
+
+WRITE_SECONDS = metrics.histogram("embed_write_seconds", "Time to append one batch to the store and journal")
 
 
 def sanitize_datetime(dt_str: str) -> str:
@@ -66,17 +107,6 @@ def sanitize_datetime(dt_str: str) -> str:
     return dt_str.replace(":", "-")
 
 
-def is_in_time_range(example, start_dt, end_dt):
-    """
-    Returns True if example's 'created_at' is between start_dt (inclusive)
-    and end_dt (exclusive).
-    """
-    # Convert "Z" suffix to '+00:00' for parsing
-    aware_str = example["created_at"].replace("Z", "+00:00")
-    dt = parser.isoparse(aware_str)
-    return start_dt <= dt < end_dt
-
-
 def safe_text(txt, max_chars=5000):
     """
     Cleans and truncates text to a maximum of `max_chars`.
@@ -85,26 +115,44 @@ def safe_text(txt, max_chars=5000):
     return txt[:max_chars]
 
 
-def load_existing_partial_results(csv_path: str) -> pd.DataFrame:
+def local_model_key(model_id: str, runtime: str, pooling: str, max_length: int) -> str:
     """
-    If there's an existing CSV from a previous partial run,
-    load it and parse the 'embedding' column from JSON.
+    Returns the embedding cache key of the local backend. Quantized runtimes
+    and other poolings give different vectors, so they get their own key.
     """
-    if not os.path.exists(csv_path):
-        return pd.DataFrame()
-
-    print(f"Found existing partial CSV: {csv_path}")
-    df_partial = pd.read_csv(csv_path)
-    if "embedding" in df_partial.columns:
-        df_partial["embedding"] = df_partial["embedding"].apply(
-            lambda x: json.loads(x) if isinstance(x, str) else x
-        )
-    return df_partial
+    key = f"{model_id}@{max_length}"
+    if (runtime, pooling) != (NOTEBOOK_RUNTIME, NOTEBOOK_POOLING):
+        key += f"/{runtime}/{pooling}"
+    return key
+
+
+def load_progress(store: EmbeddingStore, window_size: int) -> ProgressJournal:
+    """
+    Opens the progress journal of `store` and marks the rows the store holds
+    beyond what the journal covers. Only that tail of the store's metadata
+    is read; the embeddings themselves never are.
+
+    Raises ValueError if the stored rows belong to a window of another size
+    (e.g. a newer dataset version): their indices would mark the wrong posts.
+    """
+    recorded_size = ProgressJournal.recorded_size(store.path)
+    if len(store) and recorded_size not in (None, window_size):
+        raise ValueError(f"{store.path} holds {len(store)} rows of a window of {recorded_size} posts, "
+                         f"but the window now has {window_size}; move the store away to start over")
+    journal = ProgressJournal(store.path, window_size)
+    if len(store) > journal.store_rows:
+        print(f"Syncing progress journal with {len(store) - journal.store_rows} stored rows")
+        indices = store.metadata(columns=["index"], start_row=journal.store_rows)["index"].to_numpy()
+        if len(indices) and indices.max() >= window_size:
+            raise ValueError(f"{store.path} holds row index {indices.max()}, "
+                             f"but the window only has {window_size} posts")
+        journal.mark(indices, len(store))
+    return journal
 
 
 def main(args):
     ###########################################################################
-    # 0. Figure out the output CSV path (in ../data/) and create the folder
+    # 0. Figure out the output store path (in ../data/) and create the folder
     ###########################################################################
     script_dir = os.path.dirname(os.path.abspath(__file__))
     data_dir = os.path.join(script_dir, "..", "data")
@@ -113,16 +161,43 @@ def main(args):
     # Build filename encoding the time range
     start_str_sanitized = sanitize_datetime(args.start_time)
     end_str_sanitized = sanitize_datetime(args.end_time)
-    csv_filename = f"subset_{start_str_sanitized}_{end_str_sanitized}_embedded.csv"
-    output_csv_path = os.path.join(data_dir, csv_filename)
+    # A deduplicated window has different rows, so it gets its own store
+    suffix = "_dedup" if args.dedup else ""
+    # So are embeddings of a different model, runtime, pooling or truncation
+    if args.backend == "local":
+        suffix += f"_{os.path.basename(args.local_model)}_{args.runtime}_{args.pooling}_{args.max_length}"
+    store_name = f"subset_{start_str_sanitized}_{end_str_sanitized}_embedded{suffix}.embstore"
+    output_store_path = os.path.join(data_dir, store_name)
 
-    print(f"Will save results to: {output_csv_path}")
+    print(f"Will save results to: {output_store_path}")
+    store = EmbeddingStore(output_store_path, dtype=args.dtype)
 
     ###########################################################################
-    # 1. Set up client for the existing endpoint
+    # 1. Set up client for the existing endpoint, or the local CPU backend
     ###########################################################################
-    print(f"Using existing endpoint: {ENDPOINT_URL}")
-    client = InferenceClient(ENDPOINT_URL)
+    if args.backend == "local":
+        print(f"Embedding locally with {args.local_model} ({args.runtime})")
+        client = LocalEmbedder(
+            args.local_model,
+            runtime=args.runtime,
+            pooling=args.pooling,
+            max_length=args.max_length,
+            workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+            max_batch_tokens=args.max_batch_tokens,
+            max_batch_size=args.max_batch_size,
+        )
+        model_key = local_model_key(args.local_model, args.runtime, args.pooling, args.max_length)
+    else:
+        print(f"Using existing endpoint: {ENDPOINT_URL}")
+        client = EmbeddingClient(
+            ENDPOINT_URL,
+            token=os.environ.get("HF_API_TOKEN") or get_token(),
+            concurrency=args.concurrency,
+            max_batch_tokens=args.max_batch_tokens,
+            max_batch_size=args.max_batch_size,
+        )
+        model_key = args.model_id
 
     ###########################################################################
     # 2. Load dataset and filter by time range, then discard empty text
@@ -138,13 +213,17 @@ def main(args):
     if end_dt.tzinfo is None:
         end_dt = end_dt.replace(tzinfo=timezone.utc)
 
+    # Parsed once per dataset version; each time range is then a binary search
+    time_index = TimeIndex.for_dataset(ds)
+
     print(f"Filtering dataset for posts between {start_dt} and {end_dt}...")
-    ds_time = ds.filter(lambda x: is_in_time_range(x, start_dt, end_dt))
-    print("Found", len(ds_time), "posts in that time range.")
+    rows = time_index.rows_between(start_dt, end_dt, drop_empty=False)
+    print("Found", len(rows), "posts in that time range.")
 
     # Discard any post whose text is empty (after stripping)
     print("Discarding posts with empty text...")
-    ds_time = ds_time.filter(lambda x: len(x["text"].strip()) > 0)
+    rows = rows[time_index.non_empty[rows]]
+    ds_time = ds.select(rows)
     print("Remaining after removing empty text:", len(ds_time), "\n")
 
     if len(ds_time) == 0:
@@ -152,67 +231,88 @@ def main(args):
         sys.exit(0)
 
     df_time = ds_time.to_pandas().reset_index(drop=True)
+
+    if args.dedup:
+        # Deterministic for a given window, so resumed runs see the same rows
+        representatives, multiplicity = collapse_near_duplicates(df_time["text"].tolist())
+        df_time = df_time.iloc[representatives].reset_index(drop=True)
+        df_time["multiplicity"] = multiplicity
+        print(f"Collapsed near-duplicates: {len(representatives)} representative posts "
+              f"out of {multiplicity.sum()}.\n")
+
     df_time["index"] = df_time.index  # We'll track unique row indices
 
     ###########################################################################
     # 3. Check partial results once, skip what's done
     ###########################################################################
-    partial_df = load_existing_partial_results(output_csv_path)
+    journal = load_progress(store, len(df_time))
+    completed = journal.completed()  # aligned with df_time["index"]
 
-    if not partial_df.empty:
-        processed_indices = set(partial_df["index"])
-        unprocessed_df = df_time[~df_time["index"].isin(processed_indices)]
-        print(f"Skipping {len(processed_indices)} already processed posts.")
-    else:
-        unprocessed_df = df_time
+    if completed.any():
+        print(f"Skipping {completed.sum()} already processed posts.")
+    unprocessed_df = df_time[~completed]
 
     if unprocessed_df.empty:
         print("All posts in this time range are already embedded.")
         sys.exit(0)
 
     ###########################################################################
-    # 4. Embed in batches, *append* partial results to CSV
+    # 4. Embed in batches, *append* partial results to the store
     ###########################################################################
-    indices = list(unprocessed_df.index)
-
-    # We'll keep track if the file already exists, so we know whether to write a header.
-    file_exists = os.path.exists(output_csv_path)
-
-    for start_idx in tqdm(range(0, len(indices), BATCH_SIZE), desc="Embedding Batches"):
-        batch_indices = indices[start_idx : start_idx + BATCH_SIZE]
-        batch_texts = [safe_text(unprocessed_df.loc[i, "text"]) for i in batch_indices]
-
-        # Inference call - pass "task=feature-extraction" to get embeddings
-        response = client.post(
-            json={"inputs": batch_texts, "truncate": True},
-            task="feature-extraction",
-        )
-
-        # The response is raw bytes; decode -> JSON -> NumPy
-        batch_embeddings = np.array(json.loads(response.decode()))
-
-        # Prepare a DataFrame of this batch
-        rows_for_csv = []
-        for idx_in_batch, row_emb in zip(batch_indices, batch_embeddings):
-            row_dict = unprocessed_df.loc[idx_in_batch].to_dict()
-            # Convert embedding to JSON for storage in CSV
-            row_dict["embedding"] = json.dumps(row_emb.tolist())
-            rows_for_csv.append(row_dict)
-
-        new_batch_df = pd.DataFrame(rows_for_csv)
-
-        # Append to CSV: write a header only if the file does not already exist
-        mode = "a" if file_exists else "w"
-        header = not file_exists
+    # Columnar views of the pending rows; batches are sliced out by position
+    metadata_table = pa.Table.from_pandas(unprocessed_df, preserve_index=False)
+    window_indices = unprocessed_df["index"].to_numpy()
+    texts = [safe_text(t) for t in unprocessed_df["text"]]
+
+    # Identical texts are embedded once and fanned back out to all their rows
+    cache = EmbeddingCache(os.path.join(data_dir, CACHE_FILENAME), model_key,
+                           max_bytes=int(args.cache_max_gb * GB))
+    keys, positions_by_key, text_by_key = cache.group_duplicates(texts)
+    cached = cache.get_many(list(positions_by_key))
+    print(f"{len(texts)} posts, {len(positions_by_key)} distinct texts, "
+          f"{len(cached)} of them already cached.")
+
+    stop_reporting = metrics.start_reporting(args)
+    progress = tqdm(total=len(texts), desc="Embedding posts")
+    batches_written = 0
+
+    def write_rows(batch_keys, batch_embeddings):
+        # Repeat each embedding once per row that shares its text
+        positions = [positions_by_key[key] for key in batch_keys]
+        counts = [len(p) for p in positions]
+        positions = np.concatenate(positions)
+        with WRITE_SECONDS.time():
+            store.append(np.repeat(batch_embeddings, counts, axis=0), metadata_table.take(positions))
+            journal.mark(window_indices[positions], len(store))
+        progress.update(len(positions))
+
+    def write_batch(batch_keys, batch_embeddings):
+        nonlocal batches_written
+
+        cache.put_many(batch_keys, batch_embeddings)
+        write_rows(batch_keys, batch_embeddings)
+
+        batches_written += 1
+        # Periodic checkpoint message
+        if batches_written % args.checkpoint_interval == 0:
+            print(f"[Checkpoint] Appended {batches_written} batches to {output_store_path}")
 
-        new_batch_df.to_csv(output_csv_path, mode=mode, header=header, index=False)
-        file_exists = True  # After first write, the file definitely exists now
+    cached_keys = list(cached)
+    for start in range(0, len(cached_keys), CACHED_WRITE_CHUNK):
+        chunk = cached_keys[start:start + CACHED_WRITE_CHUNK]
+        write_rows(chunk, np.stack([cached[key] for key in chunk]))
 
-        # Periodic checkpoint message
-        if (start_idx // BATCH_SIZE) % args.checkpoint_interval == 0:
-            print(f"[Checkpoint] Appended up to row {start_idx + BATCH_SIZE} in {output_csv_path}")
+    # Batches finish out of order; rows are matched back up by their "index" column
+    missing_keys = [key for key in positions_by_key if key not in cached]
+    if missing_keys:
+        report = client.embed(missing_keys, [text_by_key[key] for key in missing_keys], write_batch)
+        print(f"Throughput: {report}")
+    progress.close()
+    print(f"Cache: {cache.stats()}")
+    cache.close()
+    stop_reporting()
 
-    print(f"\nDone. Appended all new embeddings to CSV: {output_csv_path}\n")
+    print(f"\nDone. Appended all new embeddings to store: {output_store_path}\n")
 
 
 if __name__ == "__main__":
@@ -224,7 +324,36 @@ if __name__ == "__main__":
     arg_parser.add_argument("--end_time", type=str, required=True,
                            help="ISO datetime for end (exclusive).")
     arg_parser.add_argument("--checkpoint_interval", type=int, default=1,
-                           help="Save partial CSV after every N batches.")
+                           help="Print a checkpoint message after every N batches.")
+    arg_parser.add_argument("--concurrency", type=int, default=CONCURRENCY,
+                           help="Number of embedding requests in flight at once.")
+    arg_parser.add_argument("--max_batch_tokens", type=int, default=MAX_BATCH_TOKENS,
+                           help="Estimated token budget of a single request.")
+    arg_parser.add_argument("--max_batch_size", type=int, default=MAX_BATCH_SIZE,
+                           help="Maximum number of texts in a single request.")
+    arg_parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16"],
+                           help="Storage precision of a new embedding store.")
+    arg_parser.add_argument("--model_id", type=str, default=MODEL_ID,
+                           help="Model served by the endpoint; cached embeddings are keyed by it.")
+    arg_parser.add_argument("--cache_max_gb", type=float, default=8.0,
+                           help="Evict least recently used cache entries beyond this size.")
+    arg_parser.add_argument("--dedup", action="store_true",
+                           help="Embed one representative per group of near-duplicate posts.")
+    arg_parser.add_argument("--backend", type=str, default="endpoint", choices=["endpoint", "local"],
+                           help="Embed through the inference endpoint or on local CPUs.")
+    arg_parser.add_argument("--local_model", type=str, default=LOCAL_MODEL_ID,
+                           help="Hugging Face model of the local backend.")
+    arg_parser.add_argument("--runtime", type=str, default="onnx-int8", choices=RUNTIMES,
+                           help="Inference runtime of the local backend.")
+    arg_parser.add_argument("--pooling", type=str, default="last", choices=POOLING,
+                           help="How the local backend pools token states into one embedding.")
+    arg_parser.add_argument("--max_length", type=int, default=300,
+                           help="Truncate texts to this many tokens in the local backend.")
+    arg_parser.add_argument("--workers", type=int, default=None,
+                           help="Local inference processes (default: one per core / threads_per_worker).")
+    arg_parser.add_argument("--threads_per_worker", type=int, default=1,
+                           help="Intra-op threads of every local inference process.")
+    metrics.add_arguments(arg_parser)
     args = arg_parser.parse_args()
 
     main(args)
\ No newline at end of file
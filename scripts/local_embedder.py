@@ -0,0 +1,274 @@
+"""
+local_embedder.py
+
+CPU embedding backend for load_embed.py, for backfills on nodes without a
+GPU or an inference endpoint. `LocalEmbedder.embed` has the same contract as
+`EmbeddingClient.embed`, so the two are interchangeable (--backend).
+
+  - Texts are tokenized once up front, sorted by token count and cut into
+    batches of similar length under a token budget (`max_batch_tokens`
+    counts padded tokens), so hardly any compute is spent on padding.
+  - Batches are sharded over `workers` processes with `threads_per_worker`
+    intra-op threads each; every worker loads the model once. The longest
+    batches go out first so no worker is left with a long tail.
+  - Inference runs in one of three runtimes:
+      onnx        ONNX Runtime on a model exported with optimum
+      onnx-int8   the same export with dynamically quantized int8 weights
+      torch-int8  PyTorch with int8 dynamic quantization of the Linear layers
+    ONNX exports are cached next to the data, under onnx/<model>/.
+  - Pooling is "last" (last real token, e.g. gte-Qwen2), "mean" or "cls";
+    embeddings are L2-normalized.
+
+The report adds tokens/s per core (over the time the workers spent in
+inference, so model loading does not count) and the share of real
+(non-padding) tokens to the posts/s and tokens/s of the endpoint client.
+"""
+
+import multiprocessing as mp
+import os
+import shutil
+import time
+
+import numpy as np
+
+import metrics
+
+RUNTIMES = ("onnx", "onnx-int8", "torch-int8")
+POOLING = ("last", "mean", "cls")
+
+BATCH_SECONDS = metrics.histogram("embed_local_batch_seconds", "Inference time of one local batch in a worker")
+POSTS_EMBEDDED = metrics.counter("embed_posts_total", "Texts embedded")
+TOKENS_EMBEDDED = metrics.counter("embed_tokens_total", "Estimated tokens embedded")
+
+# Set in every worker process by _init_worker
+_worker = None
+
+
+def available_cores() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not on Linux
+        return os.cpu_count() or 1
+
+
+def length_batches(lengths: np.ndarray, max_batch_tokens: int, max_batch_size: int) -> list:
+    """
+    Groups positions into batches of similar token length. A batch is padded
+    to its longest text, so `max_batch_tokens` bounds rows x longest length.
+    Returns arrays of positions, longest batches first.
+    """
+    order = np.argsort(lengths, kind="stable")[::-1]
+    batches = []
+    start = 0
+    while start < len(order):
+        # Sorted longest first, so the first text of a batch sets its padding
+        rows = max(1, min(max_batch_size, max_batch_tokens // max(int(lengths[order[start]]), 1)))
+        batches.append(order[start:start + rows])
+        start += rows
+    return batches
+
+
+def onnx_export_path(model_id: str, cache_dir: str, runtime: str) -> str:
+    """
+    Returns the path of the (quantized) ONNX export of `model_id`, exporting
+    it first if needed. Only ever called from the main process.
+    """
+    export_dir = os.path.join(cache_dir, model_id.replace("/", "__"))
+    model_path = os.path.join(export_dir, "model.onnx")
+    if not os.path.exists(model_path):
+        from optimum.exporters.onnx import main_export
+
+        print(f"Exporting {model_id} to ONNX in {export_dir} (one time)...")
+        main_export(model_id, output=export_dir, task="feature-extraction", trust_remote_code=True)
+
+    if runtime == "onnx-int8":
+        quantized_path = os.path.join(export_dir, "model_int8.onnx")
+        if not os.path.exists(quantized_path):
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            print(f"Quantizing {model_path} to int8 (one time)...")
+            # The weights go to a side file (protobuf caps a single .onnx file
+            # at 2 GB) that the model refers to by name, so both are written
+            # under their final names in a scratch directory and the model
+            # moves last
+            tmp_dir = quantized_path + ".tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            tmp_path = os.path.join(tmp_dir, os.path.basename(quantized_path))
+            quantize_dynamic(model_path, tmp_path, weight_type=QuantType.QInt8, use_external_data_format=True)
+            for name in os.listdir(tmp_dir):
+                if name != os.path.basename(quantized_path):
+                    os.replace(os.path.join(tmp_dir, name), os.path.join(export_dir, name))
+            os.replace(tmp_path, quantized_path)
+            shutil.rmtree(tmp_dir)
+        return quantized_path
+    return model_path
+
+
+class _OnnxModel:
+    def __init__(self, path: str, threads: int):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def __call__(self, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        feed = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feed["token_type_ids"] = np.zeros_like(input_ids)
+        if "position_ids" in self.input_names:
+            feed["position_ids"] = np.broadcast_to(np.arange(input_ids.shape[1], dtype=np.int64), input_ids.shape).copy()
+        return self.session.run(None, feed)[0]
+
+
+class _TorchInt8Model:
+    def __init__(self, model_id: str, threads: int):
+        import torch
+        from transformers import AutoModel
+
+        torch.set_num_threads(threads)
+        model = AutoModel.from_pretrained(model_id, trust_remote_code=True).eval()
+        self.model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.torch = torch
+
+    def __call__(self, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        with self.torch.inference_mode():
+            output = self.model(input_ids=self.torch.from_numpy(input_ids),
+                                attention_mask=self.torch.from_numpy(attention_mask))
+        return output[0].float().numpy()
+
+
+def _init_worker(runtime: str, model_source: str, threads: int, pooling: str, pad_id: int):
+    global _worker
+    model = _TorchInt8Model(model_source, threads) if runtime == "torch-int8" else _OnnxModel(model_source, threads)
+    _worker = (model, pooling, pad_id)
+
+
+def _pool(hidden: np.ndarray, lengths: np.ndarray, mask: np.ndarray, pooling: str) -> np.ndarray:
+    # An empty sequence is pooled like one token instead of indexing -1 or dividing by 0
+    lengths = np.maximum(lengths, 1)
+    if pooling == "last":
+        # Padding is on the right, so the last real token sits at length - 1
+        pooled = hidden[np.arange(len(lengths)), lengths - 1]
+    elif pooling == "cls":
+        pooled = hidden[:, 0]
+    else:
+        pooled = (hidden * mask[..., None]).sum(axis=1) / lengths[:, None]
+    pooled = pooled.astype(np.float32)
+    return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+
+def _embed_batch(batch):
+    """
+    Worker task: pads one batch of token ids and returns
+    (indices, embeddings, real tokens, padded tokens, seconds).
+    """
+    indices, token_ids = batch
+    model, pooling, pad_id = _worker
+    start = time.perf_counter()
+
+    lengths = np.fromiter((len(ids) for ids in token_ids), dtype=np.int64, count=len(token_ids))
+    # Texts without any token (a tokenizer with no special tokens) attend one
+    # pad token, so no row is fully masked
+    attended = np.maximum(lengths, 1)
+    width = int(attended.max())
+    input_ids = np.full((len(token_ids), width), pad_id, dtype=np.int64)
+    attention_mask = np.zeros((len(token_ids), width), dtype=np.int64)
+    for row, ids in enumerate(token_ids):
+        input_ids[row, :len(ids)] = ids
+        attention_mask[row, :attended[row]] = 1
+
+    embeddings = _pool(model(input_ids, attention_mask), attended, attention_mask, pooling)
+    return indices, embeddings, int(lengths.sum()), input_ids.size, time.perf_counter() - start
+
+
+class LocalEmbedder:
+    def __init__(self, model_id: str, runtime: str = "onnx-int8", pooling: str = "last",
+                 max_length: int = 300, workers: int = None, threads_per_worker: int = 1,
+                 max_batch_tokens: int = 8192, max_batch_size: int = 64,
+                 cache_dir: str = None, report_interval: float = 30.0):
+        if runtime not in RUNTIMES:
+            raise ValueError(f"Unknown runtime {runtime!r}, expected one of {RUNTIMES}")
+        if pooling not in POOLING:
+            raise ValueError(f"Unknown pooling {pooling!r}, expected one of {POOLING}")
+        self.model_id = model_id
+        self.runtime = runtime
+        self.pooling = pooling
+        self.max_length = max_length
+        self.threads_per_worker = threads_per_worker
+        self.workers = workers or max(1, available_cores() // threads_per_worker)
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "onnx")
+        self.report_interval = report_interval
+
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
+        pad_id = self.tokenizer.pad_token_id
+        self.pad_id = pad_id if pad_id is not None else (self.tokenizer.eos_token_id or 0)
+
+    def _report(self, start: float, posts: int, tokens: int, padded: int, batches: int,
+                busy_seconds: float) -> dict:
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        cores = self.workers * self.threads_per_worker
+        return {
+            "posts": posts,
+            "batches": batches,
+            "workers": self.workers,
+            "cores": cores,
+            "elapsed_s": round(elapsed, 2),
+            "posts_per_s": round(posts / elapsed, 1),
+            "tokens_per_s": round(tokens / elapsed, 1),
+            "tokens_per_s_per_core": round(tokens / max(busy_seconds * self.threads_per_worker, 1e-9), 1),
+            "padding_efficiency": round(tokens / max(padded, 1), 3),
+        }
+
+    def embed(self, indices, texts, on_batch) -> dict:
+        """
+        Embeds `texts` and calls `on_batch(batch_indices, embeddings)` for
+        every finished batch, in completion order (not input order).
+        Returns the final throughput report.
+        """
+        indices = list(indices)
+        start = time.perf_counter()
+        token_ids = self.tokenizer(list(texts), truncation=True, max_length=self.max_length)["input_ids"]
+        lengths = np.fromiter((len(ids) for ids in token_ids), dtype=np.int64, count=len(token_ids))
+        batches = [([indices[p] for p in positions], [token_ids[p] for p in positions])
+                   for positions in length_batches(lengths, self.max_batch_tokens, self.max_batch_size)]
+        print(f"[Embedding] Tokenized {len(texts)} texts into {len(batches)} length-bucketed batches "
+              f"in {time.perf_counter() - start:.1f}s")
+
+        if self.runtime == "torch-int8":
+            model_source = self.model_id
+        else:
+            model_source = onnx_export_path(self.model_id, self.cache_dir, self.runtime)
+
+        start = time.perf_counter()
+        last_report = start
+        posts = tokens = padded = done = 0
+        busy_seconds = 0.0
+        # spawn: the workers must not inherit the tokenizer's or torch's thread pools
+        context = mp.get_context("spawn")
+        with context.Pool(self.workers, initializer=_init_worker,
+                          initargs=(self.runtime, model_source, self.threads_per_worker,
+                                    self.pooling, self.pad_id)) as pool:
+            for batch_indices, embeddings, real_tokens, padded_tokens, seconds in pool.imap_unordered(_embed_batch, batches):
+                BATCH_SECONDS.observe(seconds)
+                POSTS_EMBEDDED.inc(len(batch_indices))
+                TOKENS_EMBEDDED.inc(real_tokens)
+                on_batch(batch_indices, embeddings)
+
+                posts += len(batch_indices)
+                tokens += real_tokens
+                padded += padded_tokens
+                busy_seconds += seconds
+                done += 1
+                now = time.perf_counter()
+                if now - last_report >= self.report_interval:
+                    last_report = now
+                    print(f"[Embedding] {self._report(start, posts, tokens, padded, done, busy_seconds)}")
+        return self._report(start, posts, tokens, padded, done, busy_seconds)
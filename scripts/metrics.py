@@ -0,0 +1,375 @@
+"""
+metrics.py
+
+Lightweight in-process metrics for the scraper, the embedding jobs and the
+clustering code:
+
+  - `Counter`, `Gauge` and `Histogram` (latencies in fixed buckets), created
+    on first use through the process-wide `REGISTRY`,
+  - `start_http_server(port)` serves them in the Prometheus text format on
+    http://127.0.0.1:<port>/metrics,
+  - `JsonLogger` appends one JSON line per interval with counter rates and
+    the histogram quantiles of that interval,
+  - `SamplingProfiler` samples the Python stacks of all threads and writes
+    them in the collapsed format of flamegraph.pl / speedscope.
+
+Scripts expose these as --metrics_port, --metrics_log, --metrics_interval
+and --profile with `add_arguments(arg_parser)` and `start_reporting(args)`.
+
+Recording a value costs a lock and a few additions, so the metrics stay on
+in the hot paths; exporting only happens when one of the above is started.
+"""
+
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from 100 microseconds to a minute
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Fractions, e.g. how full a batch is
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+
+class Counter:
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Gauge:
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._value = 0
+
+    def set(self, value):
+        self._value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Histogram:
+    def __init__(self, name: str, help: str = "", buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # One count per bucket plus the overflow bucket (+Inf)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def snapshot(self):
+        """
+        Returns (per-bucket counts, sum) at this moment.
+        """
+        with self._lock:
+            return list(self._counts), self._sum
+
+    def quantile(self, q: float, counts=None) -> float:
+        """
+        Estimates the q-quantile by interpolating inside its bucket, like
+        Prometheus' histogram_quantile. Returns NaN without observations.
+        """
+        counts = counts if counts is not None else self.snapshot()[0]
+        total = sum(counts)
+        if total == 0:
+            return float("nan")
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get(self, cls, name: str, help: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Metric {name!r} is already a {type(metric).__name__}")
+            return metric
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str = "", buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def metrics(self) -> list:
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+    def prometheus_text(self) -> str:
+        """
+        Renders all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics():
+            kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+            if metric.help:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            if isinstance(metric, Histogram):
+                counts, total = metric.snapshot()
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'{metric.name}_bucket{{le="{le}"}} {cumulative}')
+                lines.append(f"{metric.name}_sum {total}")
+                lines.append(f"{metric.name}_count {cumulative}")
+            else:
+                lines.append(f"{metric.name} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def start_http_server(port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """
+    Serves `registry` on http://<host>:<port>/metrics from a daemon thread
+    and returns the server (call .shutdown() to stop it).
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="metrics-http").start()
+    return server
+
+
+class JsonLogger:
+    """
+    Appends one JSON line per `interval` seconds to `path` ("-" for stdout):
+    counter totals and per-second rates, gauge values, and the count, mean,
+    p50, p95 and p99 of every histogram over that interval.
+    """
+
+    def __init__(self, path: str, interval: float = 30.0, registry: Registry = REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_time = time.monotonic()
+        self._last_counters = {}
+        self._last_histograms = {}
+
+    def record(self) -> dict:
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-9)
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "interval_s": round(elapsed, 3)}
+        for metric in self.registry.metrics():
+            if isinstance(metric, Counter):
+                value = metric.value
+                rate = (value - self._last_counters.get(metric.name, 0)) / elapsed
+                self._last_counters[metric.name] = value
+                record[metric.name] = {"total": value, "per_s": round(rate, 3)}
+            elif isinstance(metric, Gauge):
+                record[metric.name] = metric.value
+            else:
+                counts, total = metric.snapshot()
+                last_counts, last_total = self._last_histograms.get(metric.name, ([0] * len(counts), 0.0))
+                self._last_histograms[metric.name] = (counts, total)
+                # Only the observations of this interval
+                counts = [c - last for c, last in zip(counts, last_counts)]
+                n = sum(counts)
+                record[metric.name] = {
+                    "count": n,
+                    "mean": round((total - last_total) / n, 6) if n else None,
+                    **{f"p{int(q * 100)}": round(metric.quantile(q, counts), 6) if n else None
+                       for q in (0.5, 0.95, 0.99)},
+                }
+        self._last_time = now
+        return record
+
+    def write(self):
+        line = json.dumps(self.record())
+        if self.path == "-":
+            print(line, flush=True)
+        else:
+            with open(self.path, "a") as f:
+                f.write(line + "\n")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="metrics-json")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the logger after writing a final line.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+
+
+class SamplingProfiler:
+    """
+    Samples the Python stack of every thread but the metrics threads each
+    `interval` seconds. `stop()` writes the collapsed stacks ("outer;inner
+    count" per line) to `path` and returns (function, share of all stack
+    samples) of the functions most often on top of a stack.
+    """
+
+    def __init__(self, path: str, interval: float = 0.005):
+        self.path = path
+        self.interval = interval
+        self.stacks = StackCounter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _frame_name(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            # The exporters mostly wait and would drown out the real work
+            skipped = {thread.ident for thread in threading.enumerate() if thread.name.startswith("metrics-")}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in skipped:
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(self._frame_name(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="metrics-profiler")
+        self._thread.start()
+        return self
+
+    def stop(self, top: int = 15) -> list:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        os.replace(tmp_path, self.path)
+
+        leaves = StackCounter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        total = max(sum(leaves.values()), 1)
+        return [(name, count / total) for name, count in leaves.most_common(top)]
+
+
+def add_arguments(arg_parser):
+    arg_parser.add_argument("--metrics_port", type=int, default=0,
+                            help="Serve Prometheus metrics on 127.0.0.1:PORT/metrics (0 disables).")
+    arg_parser.add_argument("--metrics_log", type=str, default=None,
+                            help="Append a JSON line of metrics per interval to this file ('-' for stdout).")
+    arg_parser.add_argument("--metrics_interval", type=float, default=30.0,
+                            help="Seconds between two JSON metric lines.")
+    arg_parser.add_argument("--profile", type=str, default=None,
+                            help="Sample all thread stacks and write them here (collapsed format) on exit.")
+
+
+def start_reporting(args):
+    """
+    Starts whatever `add_arguments` options are set and returns a function
+    that stops them, writing the last JSON line and the profile.
+    """
+    server = start_http_server(args.metrics_port) if args.metrics_port else None
+    logger = JsonLogger(args.metrics_log, args.metrics_interval).start() if args.metrics_log else None
+    profiler = SamplingProfiler(args.profile).start() if args.profile else None
+    if server is not None:
+        print(f"Serving metrics on http://127.0.0.1:{args.metrics_port}/metrics")
+
+    def stop():
+        if server is not None:
+            server.shutdown()
+        if logger is not None:
+            logger.stop()
+        if profiler is not None:
+            top = profiler.stop()
+            print(f"Wrote {profiler.samples} stack samples to {profiler.path}; most sampled functions:")
+            for name, share in top:
+                print(f"  {share:6.1%}  {name}")
+    return stop
@@ -0,0 +1,82 @@
+"""
+post_buffer.py
+
+Per-day post buffers for the firehose scraper with constant-time memory
+accounting.
+
+Instead of walking every buffered object to measure memory, the size of each
+post is estimated once when it is appended (a handful of O(1) `getsizeof`
+calls) and subtracted again when its buffer is flushed. The running totals
+make a byte budget cheap to enforce: when it is exceeded, the least recently
+used day is evicted by flushing it to disk.
+"""
+
+from collections import OrderedDict
+from sys import getsizeof
+
+# Pointer slot a list spends on each element
+LIST_SLOT_BYTES = 8
+
+
+def estimate_post_bytes(post: dict) -> int:
+    """
+    Approximate resident size of a post dict and its values. Constant time
+    per post: `getsizeof` on a str reads its stored length.
+    """
+    size = getsizeof(post) + LIST_SLOT_BYTES
+    for value in post.values():
+        size += getsizeof(value)
+    return size
+
+
+class DayBuffers:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        # day -> list of posts, ordered from least to most recently appended to
+        self._posts = OrderedDict()
+        self._bytes = {}
+        self.total_bytes = 0
+        self.total_posts = 0
+
+    def append(self, day: str, post: dict) -> int:
+        """
+        Buffers `post` under `day` and returns its estimated size in bytes.
+        """
+        size = estimate_post_bytes(post)
+        if day not in self._posts:
+            self._posts[day] = []
+            self._bytes[day] = 0
+        else:
+            self._posts.move_to_end(day)
+        self._posts[day].append(post)
+        self._bytes[day] += size
+        self.total_bytes += size
+        self.total_posts += 1
+        return size
+
+    def posts(self, day: str) -> list:
+        return self._posts.get(day, [])
+
+    def count(self, day: str) -> int:
+        return len(self._posts.get(day, ()))
+
+    def day_bytes(self, day: str) -> int:
+        return self._bytes.get(day, 0)
+
+    def days(self) -> list:
+        return list(self._posts)
+
+    def pop(self, day: str) -> list:
+        """
+        Removes and returns the buffer of `day`, releasing its bytes.
+        """
+        posts = self._posts.pop(day, [])
+        self.total_bytes -= self._bytes.pop(day, 0)
+        self.total_posts -= len(posts)
+        return posts
+
+    def over_budget(self) -> bool:
+        return self.total_bytes > self.max_bytes
+
+    def least_recent_day(self):
+        return next(iter(self._posts), None)
@@ -0,0 +1,81 @@
+"""
+progress_journal.py
+
+Bitmap of completed rows for resumable embedding runs.
+
+Bit i is set once the post with window index i has been committed to the
+embedding store. The bitmap is a memory-mapped file, so marking a batch only
+touches the pages of its bits, and resuming reads n/8 bytes instead of the
+store's metadata. `progress.json` records how many store rows the bitmap
+covers. Rows committed after that (a crash between the store append and the
+journal update) are picked up from the store's metadata tail on open.
+"""
+
+import json
+import os
+
+import numpy as np
+
+BITMAP_FILE = "progress.bitmap"
+HEADER_FILE = "progress.json"
+
+
+class ProgressJournal:
+    @staticmethod
+    def recorded_size(directory: str):
+        """
+        Returns the window size of the journal in `directory`, or None if
+        there is none.
+        """
+        header_path = os.path.join(directory, HEADER_FILE)
+        if not os.path.exists(header_path):
+            return None
+        with open(header_path) as f:
+            return json.load(f)["size"]
+
+    def __init__(self, directory: str, size: int):
+        """
+        Opens the journal of a window of `size` posts (size > 0). A journal
+        written for a different window size is reset.
+        """
+        self.size = size
+        self.bitmap_path = os.path.join(directory, BITMAP_FILE)
+        self.header_path = os.path.join(directory, HEADER_FILE)
+        self.store_rows = 0
+
+        nbytes = (size + 7) // 8
+        valid = False
+        if os.path.exists(self.header_path) and os.path.exists(self.bitmap_path):
+            with open(self.header_path) as f:
+                header = json.load(f)
+            valid = header["size"] == size and os.path.getsize(self.bitmap_path) == nbytes
+            if valid:
+                self.store_rows = header["store_rows"]
+
+        if not valid:
+            with open(self.bitmap_path, "wb") as f:
+                f.truncate(nbytes)
+        self._bits = np.memmap(self.bitmap_path, dtype=np.uint8, mode="r+", shape=(nbytes,))
+
+    def completed(self) -> np.ndarray:
+        """
+        Returns a boolean mask over the window marking committed rows.
+        """
+        return np.unpackbits(np.asarray(self._bits), count=self.size, bitorder="little").astype(bool)
+
+    def mark(self, indices: np.ndarray, store_rows: int):
+        """
+        Marks `indices` as committed; `store_rows` is the store's row count
+        after they were appended.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices):
+            # Several indices can share a byte, so OR them in one ufunc call
+            np.bitwise_or.at(self._bits, indices >> 3, (1 << (indices & 7)).astype(np.uint8))
+            self._bits.flush()
+        self.store_rows = store_rows
+
+        tmp_path = self.header_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"size": self.size, "store_rows": store_rows}, f)
+        os.replace(tmp_path, self.header_path)
@@ -0,0 +1,231 @@
+"""
+segment_writer.py
+
+Append-only Parquet storage for the firehose scraper.
+
+Every flush writes only the new rows as a small numbered segment under
+``<data_dir>/segments/<day>/``. When the day rolls over, the segments are
+streamed into a single ``<data_dir>/<day>.parquet`` with large row groups and
+the segment directory is removed. Flush cost therefore depends only on the
+batch size, not on how much of the day has already been captured, and no
+earlier posts have to be kept in memory.
+
+Compaction first renames the segment directory to a uniquely named
+``<day>.compacting-<id>`` directory and records that name in the footer of
+the new day file. A compaction interrupted by a crash is therefore finished
+on the next start without merging any segment twice.
+
+`on_segment(day, number, table)` and `on_finalize(day, day_path)` are called
+after a segment or a compacted day file is on disk, e.g. to keep the rollups
+of rollups.py up to date.
+"""
+
+import json
+import os
+import shutil
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+SEGMENT_DIR_NAME = "segments"
+COMPACTING_SUFFIX = ".compacting-"
+# Row group size of the compacted day file
+COMPACT_ROW_GROUP_SIZE = 128_000
+
+
+class DaySegmentWriter:
+    def __init__(self, data_dir: str, schema: pa.Schema, on_segment=None, on_finalize=None):
+        self.data_dir = data_dir
+        self.schema = schema
+        self.on_segment = on_segment
+        self.on_finalize = on_finalize
+        self.segment_root = os.path.join(data_dir, SEGMENT_DIR_NAME)
+        os.makedirs(self.segment_root, exist_ok=True)
+        self._next_segment = {}
+
+    def day_path(self, day: str) -> str:
+        return os.path.join(self.data_dir, f"{day}.parquet")
+
+    def segment_dir(self, day: str) -> str:
+        return os.path.join(self.segment_root, day)
+
+    def list_segments(self, day: str) -> list:
+        """
+        Returns the paths of the finished segments for `day`, in write order.
+        """
+        day_dir = self.segment_dir(day)
+        if not os.path.isdir(day_dir):
+            return []
+        names = sorted(name for name in os.listdir(day_dir) if name.endswith(".parquet"))
+        return [os.path.join(day_dir, name) for name in names]
+
+    def pending_days(self) -> list:
+        """
+        Returns the days that still have segments waiting to be compacted.
+        """
+        return sorted({
+            name.split(COMPACTING_SUFFIX)[0] for name in os.listdir(self.segment_root)
+            if os.path.isdir(os.path.join(self.segment_root, name))
+        })
+
+    def _allocate_segment(self, day: str) -> int:
+        if day not in self._next_segment:
+            existing = self.list_segments(day)
+            if existing:
+                last = os.path.basename(existing[-1])
+                self._next_segment[day] = int(last.split(".")[0]) + 1
+            else:
+                self._next_segment[day] = 0
+        number = self._next_segment[day]
+        self._next_segment[day] += 1
+        return number
+
+    def write_segment(self, day: str, posts: list, metadata: dict = None) -> int:
+        """
+        Writes `posts` (a list of dicts matching the schema) as a new segment
+        for `day` and returns the number of rows written. `metadata` is stored
+        as string key/value pairs in the segment's Parquet footer, so it
+        becomes visible atomically together with the rows.
+        """
+        if not posts:
+            return 0
+
+        day_dir = self.segment_dir(day)
+        os.makedirs(day_dir, exist_ok=True)
+        number = self._allocate_segment(day)
+        segment_path = os.path.join(day_dir, f"{number:06d}.parquet")
+
+        table = pa.Table.from_pylist(posts, schema=self.schema)
+        if metadata:
+            table = table.replace_schema_metadata(
+                {key: str(value) for key, value in metadata.items()}
+            )
+        # Write to a temporary name first so a crash never leaves a
+        # truncated segment behind that compaction would choke on
+        tmp_path = segment_path + ".tmp"
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, segment_path)
+        if self.on_segment is not None:
+            self.on_segment(day, number, table)
+
+        return table.num_rows
+
+    def latest_segment(self):
+        """
+        Returns the path of the most recently written segment across all
+        pending days, or None if there are no segments.
+        """
+        for day in reversed(self.pending_days()):
+            segments = self.list_segments(day)
+            if segments:
+                return segments[-1]
+        return None
+
+    @staticmethod
+    def read_segment_metadata(path: str) -> dict:
+        metadata = pq.read_schema(path).metadata or {}
+        return {key.decode(): value.decode() for key, value in metadata.items()}
+
+    def _conform(self, batch: pa.RecordBatch) -> pa.Table:
+        """
+        Casts a batch read from an older file to the current schema, filling
+        columns that did not exist yet with nulls.
+        """
+        columns = []
+        for field in self.schema:
+            if field.name in batch.schema.names:
+                columns.append(batch.column(field.name).cast(field.type))
+            else:
+                columns.append(pa.nulls(batch.num_rows, type=field.type))
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def _compacting_dirs(self, day: str) -> list:
+        return sorted(
+            os.path.join(self.segment_root, name) for name in os.listdir(self.segment_root)
+            if name.startswith(day + COMPACTING_SUFFIX)
+        )
+
+    @staticmethod
+    def _compacted_from(day_path: str) -> set:
+        """
+        Returns the names of the segment directories merged into `day_path`.
+        """
+        if not os.path.exists(day_path):
+            return set()
+        metadata = pq.read_schema(day_path).metadata or {}
+        return set(json.loads(metadata.get(b"compacted_from", b"[]")))
+
+    def finalize_day(self, day: str) -> int:
+        """
+        Compacts all segments of `day` (plus an already existing day file, if
+        any) into `<day>.parquet` and removes the segments. Returns the number
+        of rows in the compacted file.
+        """
+        day_path = self.day_path(day)
+        merged = self._compacted_from(day_path)
+        compacting = []
+        for path in self._compacting_dirs(day):
+            if os.path.basename(path) in merged:
+                # The day file was replaced, but the crash came before the cleanup
+                shutil.rmtree(path)
+            else:
+                compacting.append(path)
+
+        if self.list_segments(day):
+            target = os.path.join(self.segment_root, f"{day}{COMPACTING_SUFFIX}{time.time_ns()}")
+            os.replace(self.segment_dir(day), target)
+            compacting.append(target)
+            self._next_segment.pop(day, None)
+        if not compacting:
+            return 0
+
+        inputs = [os.path.join(path, name) for path in compacting
+                  for name in sorted(os.listdir(path)) if name.endswith(".parquet")]
+        if os.path.exists(day_path):
+            inputs.insert(0, day_path)
+
+        schema = self.schema.with_metadata({
+            "compacted_from": json.dumps([os.path.basename(path) for path in compacting]),
+        })
+        tmp_path = day_path + ".tmp"
+        total_rows = 0
+        pending = []
+        pending_rows = 0
+        with pq.ParquetWriter(tmp_path, schema) as writer:
+            # Stream the inputs so compaction never holds the whole day in memory
+            for path in inputs:
+                parquet_file = pq.ParquetFile(path)
+                columns = [name for name in self.schema.names
+                           if name in parquet_file.schema_arrow.names]
+                for batch in parquet_file.iter_batches(batch_size=COMPACT_ROW_GROUP_SIZE,
+                                                       columns=columns):
+                    # Older day files were written from pandas or lack newer columns
+                    pending.append(self._conform(batch))
+                    pending_rows += batch.num_rows
+                    if pending_rows >= COMPACT_ROW_GROUP_SIZE:
+                        writer.write_table(pa.concat_tables(pending))
+                        total_rows += pending_rows
+                        pending = []
+                        pending_rows = 0
+            if pending:
+                writer.write_table(pa.concat_tables(pending))
+                total_rows += pending_rows
+
+        os.replace(tmp_path, day_path)
+        for path in compacting:
+            shutil.rmtree(path)
+        if self.on_finalize is not None:
+            self.on_finalize(day, day_path)
+
+        return total_rows
+
+    def finalize_stale_days(self, current_day: str) -> list:
+        """
+        Compacts every day other than `current_day` that still has segments,
+        e.g. left behind by a previous run. Returns the compacted days.
+        """
+        stale_days = [day for day in self.pending_days() if day != current_day]
+        for day in stale_days:
+            self.finalize_day(day)
+        return stale_days
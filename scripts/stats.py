@@ -1,27 +1,94 @@
+"""
+stats.py
+
+Post counts over time, answered from the per-minute rollups (see rollups.py)
+instead of the raw day files.
+
+Command-line arguments:
+  --start       (first day or ISO datetime, UTC)
+  --end         (exclusive end; defaults to one day after --start)
+  --granularity (minute, hour or day)
+  --by_lang     (one column per language)
+  --lang        (only count these languages)
+  --sync        (build rollups for day files that have none yet first)
+  --plot        (bar chart of the counts)
+
+Example, posts per hour on 2025-01-20:
+    python stats.py --start 2025-01-20 --plot
+"""
+
+import os
+import argparse
+import time
+
 import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.ticker import FuncFormatter
 
-df = pd.read_parquet("../data/2025-01-20.parquet")
+from rollups import RollupStore
 
-# Make histogram of the number of posts per hour of the day, only considering posts from 2025-01-20
-df['timestamp'] = pd.to_datetime(df['createdAt'], format='mixed', utc=True)
-df['hour'] = df['timestamp'].dt.hour
-df['date'] = df['timestamp'].dt.date
-df_filtered = df[df['timestamp'].dt.date == pd.to_datetime('2025-01-20').date()]
-hour_counts = df_filtered.groupby('hour').size().reindex(range(24), fill_value=0)
+script_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.join(script_dir, '..', 'data')
 
-plt.figure(figsize=(10, 6))
-plt.bar(hour_counts.index, hour_counts.values,
-        width=0.8, edgecolor='black', color='cornflowerblue')
+GRANULARITIES = {"minute": "min", "hour": "h", "day": "D"}
 
 def comma_formatter(x, p):
     return format(int(x), ',')
-plt.gca().yaxis.set_major_formatter(FuncFormatter(comma_formatter))
-
-plt.xlabel('Hour of the day (UTC)')
-plt.ylabel('Number of posts')
-plt.title('Number of posts per hour of the day')
-plt.xticks(range(24))
-plt.grid(axis='y', alpha=0.5)
-plt.show()
\ No newline at end of file
+
+def plot_counts(counts, granularity):
+    plt.figure(figsize=(10, 6))
+    bottom = None
+    for column in counts.columns:
+        plt.bar(counts.index, counts[column], bottom=bottom,
+                width=pd.Timedelta(1, unit=GRANULARITIES[granularity]) * 0.8, edgecolor='black',
+                label=column if len(counts.columns) > 1 else None)
+        bottom = counts[column] if bottom is None else bottom + counts[column]
+    plt.gca().yaxis.set_major_formatter(FuncFormatter(comma_formatter))
+
+    plt.xlabel('Time (UTC)')
+    plt.ylabel('Number of posts')
+    plt.title(f'Number of posts per {granularity}')
+    if len(counts.columns) > 1:
+        plt.legend()
+    plt.grid(axis='y', alpha=0.5)
+    plt.show()
+
+def main(args):
+    rollups = RollupStore(data_dir)
+    if args.sync:
+        for day in rollups.sync():
+            print(f"Built rollup for {day}")
+
+    start = pd.Timestamp(args.start)
+    end = pd.Timestamp(args.end) if args.end else start + pd.Timedelta(days=1)
+
+    query_start = time.perf_counter()
+    counts = rollups.query(start, end, GRANULARITIES[args.granularity], by_lang=args.by_lang, langs=args.lang)
+    elapsed = time.perf_counter() - query_start
+
+    with pd.option_context("display.max_rows", None):
+        print(counts)
+    print(f"{int(counts.to_numpy().sum()):,} posts, answered in {elapsed * 1000:.1f} ms")
+
+    if args.plot:
+        plot_counts(counts, args.granularity)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Post counts per minute, hour or day from the rollups.")
+    parser.add_argument("--start", type=str, required=True,
+                        help="First day or ISO datetime (UTC), e.g. '2025-01-20'.")
+    parser.add_argument("--end", type=str, default=None,
+                        help="Exclusive end; defaults to one day after --start.")
+    parser.add_argument("--granularity", type=str, default="hour", choices=list(GRANULARITIES),
+                        help="Bucket size of the counts.")
+    parser.add_argument("--by_lang", action="store_true",
+                        help="Report one column per language.")
+    parser.add_argument("--lang", type=str, nargs="+", default=None,
+                        help="Only count posts in these languages.")
+    parser.add_argument("--sync", action="store_true",
+                        help="Build rollups for day files that have none yet before answering.")
+    parser.add_argument("--plot", action="store_true",
+                        help="Show a bar chart of the counts.")
+    args = parser.parse_args()
+
+    main(args)
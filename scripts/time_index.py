@@ -0,0 +1,94 @@
+"""
+time_index.py
+
+One-time timestamp index over a Hugging Face dataset of posts.
+
+`created_at` is parsed once, vectorized, into int64 nanoseconds since the
+epoch (UTC). The row ids are stored sorted by that timestamp, so any time range
+is two binary searches away. The non-empty-text mask is precomputed with
+Arrow kernels. The index is saved as a .npz next to the dataset's cache
+files and reused as long as the dataset fingerprint does not change.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+
+
+class TimeIndex:
+    def __init__(self, timestamps: np.ndarray, order: np.ndarray, non_empty: np.ndarray):
+        # timestamps[i] is the time of row order[i]; non_empty is per original row
+        self.timestamps = timestamps
+        self.order = order
+        self.non_empty = non_empty
+
+    @classmethod
+    def build(cls, ds, time_column: str = "created_at", text_column: str = "text") -> "TimeIndex":
+        if ds._indices is not None:
+            # Row ids must refer to ds itself, not to the table behind a select/filter
+            ds = ds.flatten_indices()
+        table = ds.data.table if hasattr(ds.data, "table") else ds.data
+
+        created_at = table.column(time_column).to_pandas()
+        # Unparseable or out-of-range timestamps become NaT and sort first
+        parsed = pd.to_datetime(created_at, utc=True, format="ISO8601", errors="coerce")
+        nanos = parsed.dt.tz_convert(None).to_numpy(dtype="datetime64[ns]").view(np.int64)
+
+        order = np.argsort(nanos, kind="stable")
+        timestamps = nanos[order]
+
+        trimmed = pc.utf8_trim_whitespace(table.column(text_column))
+        non_empty = pc.fill_null(pc.greater(pc.utf8_length(trimmed), 0), False)
+        non_empty = non_empty.to_numpy(zero_copy_only=False)
+
+        return cls(timestamps, order, non_empty)
+
+    def save(self, path: str):
+        tmp_path = path + ".tmp.npz"
+        np.savez(tmp_path, timestamps=self.timestamps, order=self.order, non_empty=self.non_empty)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "TimeIndex":
+        with np.load(path) as f:
+            return cls(f["timestamps"], f["order"], f["non_empty"])
+
+    @classmethod
+    def for_dataset(cls, ds, cache_dir: str = None, **kwargs) -> "TimeIndex":
+        """
+        Loads the index of `ds` from `cache_dir` (default: the directory of the
+        dataset's cache files), building and saving it on first use.
+        """
+        if cache_dir is None:
+            if not ds.cache_files:
+                return cls.build(ds, **kwargs)
+            cache_dir = os.path.dirname(ds.cache_files[0]["filename"])
+        path = os.path.join(cache_dir, f"time_index_{ds._fingerprint}.npz")
+
+        if os.path.exists(path):
+            return cls.load(path)
+
+        print(f"Building time index for {len(ds)} rows (one time)...")
+        index = cls.build(ds, **kwargs)
+        index.save(path)
+        return index
+
+    @staticmethod
+    def _to_nanos(dt) -> int:
+        ts = pd.Timestamp(dt)
+        ts = ts.tz_localize("UTC") if ts.tzinfo is None else ts.tz_convert("UTC")
+        return ts.value
+
+    def rows_between(self, start_dt, end_dt, drop_empty: bool = True) -> np.ndarray:
+        """
+        Returns the ids of rows with start_dt <= created_at < end_dt, in
+        dataset order. Naive datetimes are taken as UTC.
+        """
+        lo = np.searchsorted(self.timestamps, self._to_nanos(start_dt), side="left")
+        hi = np.searchsorted(self.timestamps, self._to_nanos(end_dt), side="left")
+        rows = np.sort(self.order[lo:hi])
+        if drop_empty:
+            rows = rows[self.non_empty[rows]]
+        return rows
@@ -0,0 +1,109 @@
+"""
+EmbeddingClient against the local stand-in endpoint of benchmarks/synthetic.py.
+
+The mock answers every text with a fixed vector chosen by the text's length,
+so each embedding can be checked against the text it was requested for.
+Injected 429 and 503 responses must be retried, and batches larger than the
+server accepts must be split on its 413 until they fit.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(REPO_DIR, "benchmarks"))
+sys.path.append(os.path.join(REPO_DIR, "scripts"))
+
+import embed_client
+from embed_client import EmbeddingClient, estimate_tokens, make_batches
+from synthetic import MockEmbeddingServer, random_texts
+
+DIM = 16
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    # Retry immediately instead of after up to a second
+    monkeypatch.setattr(embed_client.random, "uniform", lambda low, high: 0.0)
+
+
+def embed_all(client: EmbeddingClient, texts: list):
+    embeddings = np.full((len(texts), DIM), np.nan, dtype=np.float32)
+    calls = []
+
+    def on_batch(indices, batch):
+        calls.append(list(indices))
+        embeddings[indices] = batch
+    report = client.embed(range(len(texts)), texts, on_batch)
+    return embeddings, calls, report
+
+
+def expected_embeddings(server: MockEmbeddingServer, texts: list) -> np.ndarray:
+    return server.vectors[[len(text) % len(server.vectors) for text in texts]]
+
+
+def splits(size: int, max_inputs: int) -> int:
+    """
+    Number of 413s a batch of `size` texts gets while it is halved.
+    """
+    if size <= max_inputs:
+        return 0
+    half = size // 2
+    return 1 + splits(half, max_inputs) + splits(size - half, max_inputs)
+
+
+def test_make_batches_respects_token_and_size_budget():
+    texts = random_texts(2000, seed=2)
+    batches = make_batches(range(len(texts)), texts, max_batch_tokens=300, max_batch_size=20)
+
+    assert [i for indices, _, _ in batches for i in indices] == list(range(len(texts)))
+    for indices, batch_texts, tokens in batches:
+        assert batch_texts == [texts[i] for i in indices]
+        assert tokens == sum(estimate_tokens(text) for text in batch_texts)
+        assert len(batch_texts) <= 20
+        assert tokens <= 300 or len(batch_texts) == 1
+    # Packing, not one text per request
+    assert len(batches) < len(texts) / 5
+
+
+def test_retries_rate_limits_and_server_errors():
+    texts = random_texts(500, seed=3)
+    statuses = [429, 503, 429, 502, 503]
+    with MockEmbeddingServer(dim=DIM, latency=0.001, statuses=statuses) as server:
+        client = EmbeddingClient(server.url, concurrency=4, max_batch_tokens=1000, max_batch_size=32)
+        embeddings, calls, report = embed_all(client, texts)
+
+    np.testing.assert_array_equal(embeddings, expected_embeddings(server, texts))
+    assert sorted(i for indices in calls for i in indices) == list(range(len(texts)))
+    assert report["posts"] == len(texts)
+    assert report["retries"] == len(statuses)
+    assert [status for status, _ in server.responses if status != 200] == statuses
+    assert report["requests"] == len(make_batches(range(len(texts)), texts, 1000, 32))
+
+
+def test_splits_batches_the_server_rejects_as_too_large():
+    texts = random_texts(500, seed=4)
+    max_inputs = 10
+    with MockEmbeddingServer(dim=DIM, latency=0.001, max_inputs=max_inputs) as server:
+        client = EmbeddingClient(server.url, concurrency=4, max_batch_tokens=100_000, max_batch_size=64)
+        embeddings, calls, report = embed_all(client, texts)
+
+    np.testing.assert_array_equal(embeddings, expected_embeddings(server, texts))
+    batches = make_batches(range(len(texts)), texts, 100_000, 64)
+    # A split batch is still handed over whole, in its original order
+    assert sorted(calls) == sorted(indices for indices, _, _ in batches)
+    assert report["retries"] == 0
+    rejected = [size for status, size in server.responses if status == 413]
+    assert len(rejected) == sum(splits(len(batch_texts), max_inputs) for _, batch_texts, _ in batches)
+    assert all(size <= max_inputs for status, size in server.responses if status == 200)
+
+
+def test_gives_up_after_max_retries():
+    with MockEmbeddingServer(dim=DIM, latency=0.001, statuses=[503] * 3) as server:
+        client = EmbeddingClient(server.url, concurrency=1, max_retries=2)
+        with pytest.raises(embed_client.httpx.HTTPStatusError):
+            embed_all(client, ["a post"])
+    assert len(server.responses) == 3
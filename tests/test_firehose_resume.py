@@ -0,0 +1,199 @@
+"""
+Crash/resume test of firehose_scraper.py against a local fake firehose.
+
+The fake relay replays the same recorded #commit frames on every connection,
+starting after the `cursor` the client asks for. The scraper runs as a real
+subprocess on a copy of scripts/, so its data directory is private to the
+test. It is SIGKILLed with posts still buffered, restarted, and finally
+stopped with SIGINT. The second connection must resume from the checkpoint
+in the newest segment's footer, and the written segments must hold every
+recorded post exactly once.
+
+If persisting posts fails (e.g. a full disk), the pipeline must stop taking
+frames and shut down on its own instead of hanging, and a restart must still
+write every post exactly once.
+"""
+
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import parse_qs, urlparse
+
+import pyarrow.parquet as pq
+import pytest
+from websockets.sync.server import serve
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(REPO_DIR, "benchmarks"))
+sys.path.append(os.path.join(REPO_DIR, "scripts"))
+
+from firehose_pipeline import FirehosePipeline
+from synthetic import firehose_frame, firehose_messages, random_texts
+
+FRAMES = 1000
+POSTS_PER_FRAME = 3
+
+
+class FakeFirehose:
+    """
+    Serves subscribeRepos on ws://127.0.0.1:<port>/xrpc and records the
+    cursor of every connection.
+    """
+
+    def __init__(self, frames: list):
+        # (seq, wire bytes), in seq order
+        self.frames = frames
+        self.cursors = []
+        self.sent_all = threading.Event()
+        self.server = serve(self._handle, "127.0.0.1", 0)
+        self.uri = f"ws://127.0.0.1:{self.server.socket.getsockname()[1]}/xrpc"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def _handle(self, connection):
+        query = parse_qs(urlparse(connection.request.path).query)
+        cursor = int(query["cursor"][0]) if "cursor" in query else None
+        self.cursors.append(cursor)
+        self.sent_all.clear()
+        for seq, frame in self.frames:
+            if cursor is None or seq > cursor:
+                connection.send(frame)
+        self.sent_all.set()
+        # Keep the subscription open like a relay with no new events
+        for _ in connection:
+            pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+
+def wait_for(condition, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("condition not reached")
+        time.sleep(0.1)
+
+
+def segment_paths(data_dir: str) -> list:
+    root = os.path.join(data_dir, "segments")
+    if not os.path.isdir(root):
+        return []
+    return sorted(os.path.join(root, day, name) for day in os.listdir(root)
+                  for name in os.listdir(os.path.join(root, day)) if name.endswith(".parquet"))
+
+
+@pytest.fixture
+def scraper_dir(tmp_path):
+    shutil.copytree(os.path.join(REPO_DIR, "scripts"), tmp_path / "scripts",
+                    ignore=shutil.ignore_patterns("__pycache__"))
+    return tmp_path
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_restart_resumes_from_checkpoint(scraper_dir, workers):
+    frames, expected = recorded_frames()
+    data_dir = str(scraper_dir / "data")
+
+    with FakeFirehose(frames) as firehose:
+        command = [sys.executable, "firehose_scraper.py", "--base_uri", firehose.uri, "--workers", str(workers)]
+
+        def start():
+            return subprocess.Popen(command, cwd=scraper_dir / "scripts",
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        # A flush every 1000 posts leaves two segments and 1000 buffered posts
+        scraper = start()
+        wait_for(lambda: firehose.sent_all.is_set() and len(segment_paths(data_dir)) >= 2)
+        time.sleep(1.0)
+        scraper.kill()
+        scraper.wait()
+
+        newest = pq.read_schema(segment_paths(data_dir)[-1]).metadata
+        checkpoint_seq = int(newest[b"firehose_seq"])
+        with open(os.path.join(data_dir, "firehose_checkpoint.json")) as f:
+            assert json.load(f)["seq"] == checkpoint_seq
+
+        scraper = start()
+        wait_for(lambda: len(firehose.cursors) == 2 and firehose.sent_all.is_set())
+        time.sleep(2.0)
+        scraper.send_signal(signal.SIGINT)
+        assert scraper.wait(timeout=60) == 0
+
+    assert firehose.cursors == [None, checkpoint_seq]
+    uris = [uri for path in segment_paths(data_dir) for uri in pq.read_table(path, columns=["uri"]).column("uri").to_pylist()]
+    assert len(uris) == len(set(uris)), "posts were written twice"
+    assert set(uris) == expected, "posts were lost"
+
+
+def recorded_frames():
+    texts = random_texts(FRAMES * POSTS_PER_FRAME, seed=1, repeat_fraction=0)
+    frames = [(seq, firehose_frame(seq, texts[(seq - 1) * POSTS_PER_FRAME:seq * POSTS_PER_FRAME]))
+              for seq in range(1, FRAMES + 1)]
+    expected = {f"at://did:plc:benchmark/app.bsky.feed.post/{seq}r{i}"
+                for seq in range(1, FRAMES + 1) for i in range(POSTS_PER_FRAME)}
+    return frames, expected
+
+
+def test_pipeline_stops_taking_frames_after_writer_failure():
+    written, errors = [], []
+
+    def on_posts(posts, seq):
+        if len(written) == 50:
+            raise OSError(28, "No space left on device")
+        written.append(seq)
+
+    pipeline = FirehosePipeline(on_posts, num_workers=2, queue_size=100, on_error=errors.append)
+    pipeline.start()
+    with pytest.raises(RuntimeError):
+        for message in firehose_messages(5000) * 10:
+            pipeline.on_message(message)
+    assert isinstance(pipeline.error, OSError)
+    assert errors == [pipeline.error]
+
+    stopper = threading.Thread(target=pipeline.stop)
+    stopper.start()
+    stopper.join(timeout=60)
+    assert not stopper.is_alive(), "stop() hung after the writer failed"
+    assert not any(worker.is_alive() for worker in pipeline.workers)
+    assert written == list(range(1, 51))
+
+
+def test_scraper_exits_after_write_failure_and_restart_loses_nothing(scraper_dir):
+    frames, expected = recorded_frames()
+    data_dir = str(scraper_dir / "data")
+    # A file where today's segment directory goes makes every flush fail
+    blocker = os.path.join(data_dir, "segments", datetime.now().strftime("%Y-%m-%d"))
+    os.makedirs(os.path.dirname(blocker))
+    open(blocker, "w").close()
+
+    with FakeFirehose(frames) as firehose:
+        command = [sys.executable, "firehose_scraper.py", "--base_uri", firehose.uri, "--workers", "2"]
+        scraper = subprocess.Popen(command, cwd=scraper_dir / "scripts",
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Shuts itself down without a signal from outside
+        assert scraper.wait(timeout=60) != 0
+        os.remove(blocker)
+        assert segment_paths(data_dir) == []
+
+        scraper = subprocess.Popen(command, cwd=scraper_dir / "scripts",
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for(lambda: len(firehose.cursors) == 2 and firehose.sent_all.is_set())
+        time.sleep(2.0)
+        scraper.send_signal(signal.SIGINT)
+        assert scraper.wait(timeout=60) == 0
+
+    # Nothing was persisted, so nothing was checkpointed either
+    assert firehose.cursors == [None, None]
+    uris = [uri for path in segment_paths(data_dir) for uri in pq.read_table(path, columns=["uri"]).column("uri").to_pylist()]
+    assert len(uris) == len(set(uris)), "posts were written twice"
+    assert set(uris) == expected, "posts were lost"
@@ -0,0 +1,74 @@
+"""
+Crash tests of the day compaction in segment_writer.py.
+
+Compaction is interrupted either just before the new day file replaces the
+old one or between writing the day file and deleting the merged segments.
+Rerunning `finalize_stale_days`, as the scraper does on its next start, must
+leave every post in the day file exactly once and no segments behind.
+"""
+
+import os
+import sys
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(REPO_DIR, "scripts"))
+
+import segment_writer
+from segment_writer import DaySegmentWriter
+
+SCHEMA = pa.schema([("uri", pa.string()), ("text", pa.string())])
+DAY = "2024-11-05"
+
+
+class Killed(Exception):
+    pass
+
+
+def write_posts(writer: DaySegmentWriter, first: int, count: int, per_segment: int = 10):
+    for start in range(first, first + count, per_segment):
+        writer.write_segment(DAY, [{"uri": f"at://post/{i}", "text": f"post {i}"}
+                                   for i in range(start, min(start + per_segment, first + count))])
+
+
+def day_uris(writer: DaySegmentWriter) -> list:
+    return pq.read_table(writer.day_path(DAY), columns=["uri"]).column("uri").to_pylist()
+
+
+@pytest.mark.parametrize("crash", ["before_replace", "before_cleanup"])
+def test_interrupted_compaction_is_finished_once(tmp_path, monkeypatch, crash):
+    writer = DaySegmentWriter(str(tmp_path), SCHEMA)
+    # A day file from an earlier compaction, plus new segments for the same day
+    write_posts(writer, 0, 20)
+    writer.finalize_day(DAY)
+    write_posts(writer, 20, 35)
+
+    with monkeypatch.context() as patch:
+        if crash == "before_replace":
+            replace = os.replace
+
+            def crashing_replace(src, dst):
+                if dst == writer.day_path(DAY):
+                    raise Killed()
+                replace(src, dst)
+            patch.setattr(segment_writer.os, "replace", crashing_replace)
+        else:
+            def crashing_rmtree(path, *args, **kwargs):
+                raise Killed()
+            patch.setattr(segment_writer.shutil, "rmtree", crashing_rmtree)
+        with pytest.raises(Killed):
+            writer.finalize_day(DAY)
+
+    assert writer.pending_days() == [DAY]
+    # A fresh writer, like the scraper after a restart
+    restarted = DaySegmentWriter(str(tmp_path), SCHEMA)
+    assert restarted.finalize_stale_days("2024-11-06") == [DAY]
+
+    uris = day_uris(restarted)
+    assert len(uris) == len(set(uris)), "segments were merged twice"
+    assert set(uris) == {f"at://post/{i}" for i in range(55)}
+    assert restarted.pending_days() == []
+    assert os.listdir(restarted.segment_root) == []
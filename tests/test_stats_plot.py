@@ -0,0 +1,47 @@
+"""
+Smoke test of `stats.py --plot` on a small rollup fixture: the chart has to
+draw for every granularity, with and without one bar stack per language.
+"""
+
+import os
+import sys
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+import pyarrow as pa
+import pytest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(os.path.join(REPO_DIR, "scripts"))
+
+import stats
+from rollups import RollupStore
+
+DAY = "2025-01-20"
+
+
+@pytest.fixture
+def rollups(tmp_path):
+    store = RollupStore(str(tmp_path))
+    created_at = [f"{DAY}T{hour:02d}:{minute:02d}:00.000Z" for hour in range(0, 24, 3) for minute in (5, 35)]
+    store.add_segment(DAY, 0, pa.table({
+        "createdAt": created_at,
+        "lang": ["en", "ja"] * (len(created_at) // 2),
+    }))
+    return store
+
+
+@pytest.mark.parametrize("granularity", list(stats.GRANULARITIES))
+@pytest.mark.parametrize("by_lang", [False, True])
+def test_plot_counts(rollups, granularity, by_lang):
+    counts = rollups.query(DAY, "2025-01-21", stats.GRANULARITIES[granularity], by_lang=by_lang)
+    assert counts.to_numpy().sum() == 16
+
+    stats.plot_counts(counts, granularity)
+    try:
+        bars = plt.gca().patches
+        assert len(bars) == counts.size
+        assert sum(bar.get_height() for bar in bars) == 16
+    finally:
+        plt.close("all")